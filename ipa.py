@@ -2,8 +2,16 @@ from __future__ import annotations
 import pandas
 import numpy
 import time
+import os
+import tempfile
+import hashlib
+import pickle
+import json
+import re
+import argparse
 import molmass
 from scipy import stats
+from scipy import sparse
 import math
 import random
 import collections
@@ -13,12 +21,26 @@ from functools import partial
 from tqdm import tqdm
 from ipaPy2 import util
 from ipaPy2 import iterations
+from ipaPy2 import MS2compare
 
 __author__ = "Francesco Del Carratore"
 __maintainer__ = "Francesco Del Carratore"
 __email__ = "francescodc87@gmail.com"
 
-def clusterFeatures(df,Cthr=0.8,RTwin=1,Intmode='max'):
+# default location and size (in MB) of the disk cache used for the all adducts
+# table and the biochemical connections (see clear_cache())
+CACHE_DIR = os.environ.get('IPA_CACHE_DIR',os.path.join(os.path.expanduser('~'),'.ipa_cache'))
+CACHE_MAXSIZE = int(os.environ.get('IPA_CACHE_MAXSIZE',1024))
+# tables are cached as feather files (pyarrow). Pickle files, which run code
+# when loaded, are only written and read if IPA_CACHE_PICKLE=1
+CACHE_PICKLE = os.environ.get('IPA_CACHE_PICKLE','0')=='1'
+# names of the cache entries: only these files are ever removed from the cache
+CACHE_ENTRY = re.compile(r'^(allAdds|Bio)-[0-9a-f]{40}\.(feather|pkl)$')
+# maximum number of formulas kept by the formula service (see formula_mass())
+FORMULA_CACHE_SIZE = 100000
+
+def clusterFeatures(df,Cthr=0.8,RTwin=1,Intmode='max',engine='numpy',
+                    Corrmode='full',memlimit=1024,tmpdir=None,ncores=1,pool=None):
     """
     Clustering MS1 features based on correlation across samples.
     
@@ -38,14 +60,75 @@ def clusterFeatures(df,Cthr=0.8,RTwin=1,Intmode='max'):
     Intmode: Defines how the representative intensity of each feature is
              computed. If 'max' (default) the maximum across samples is used.
              If 'ave' the average across samples is computed
+    engine: Defines how the clusters are built. If 'numpy' (default) a single
+            correlation array and a mask of the features not yet assigned are
+            used and each cluster is found with vectorized operations. If
+            'legacy' the original list-based implementation is used. Both
+            return the same clusters.
+    Corrmode: Defines how the correlations between features are computed
+              (only used if engine='numpy'). If 'full' (default) the whole
+              correlation matrix is computed. If 'window' features are sorted
+              by RT and correlations are only computed for pairs within RTwin,
+              stored as a sparse matrix. Memory and time then grow with the
+              number of features within RTwin instead of the square of the
+              number of features. The clusters obtained are the same.
+              If 'blocked' the intensities are z-scored once and the
+              correlations are computed in float32 tiles (matrix products)
+              that are written to a memory-mapped file on disk, so that the
+              full matrix is never held in memory. Correlations are stored in
+              float32, so pairs with correlation within ~1e-6 of Cthr might be
+              treated differently than with 'full'.
+    memlimit: Default value 1024. Approximate memory (in MB) used for the
+              tiles when Corrmode='blocked'
+    tmpdir: directory where the memory-mapped file is written when
+            Corrmode='blocked'. If None (default) the system temporary
+            directory is used
+    ncores: default value 1. Number of cores used (only if engine='numpy').
+            Features are split in independent blocks wherever two consecutive
+            RTs are more than RTwin apart, and the blocks are clustered in
+            parallel. The clusters obtained are the same.
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1).
+          If None, a new pool is created for this call only.
     Returns
     -------
     df: pandas dataframe in correct format to be used as an input of the
     map_isotope_patterns() function
     """
+    if engine not in ['numpy','legacy']:
+        raise ValueError("engine not allowed")
+    if Corrmode not in ['full','window','blocked']:
+        raise ValueError("Corrmode not allowed")
+    if engine=='legacy' and Corrmode!='full':
+        raise ValueError("Corrmode can only be used with engine='numpy'")
+    if ncores<1:
+        raise ValueError("ncores must be >=1")
+    if engine=='legacy' and ncores>1:
+        raise ValueError("ncores>1 can only be used with engine='numpy'")
     print("Clustering features ....")
     start = time.time()
     df=df.replace('None',None)
+    if engine=='numpy':
+        Ints = df.iloc[:,3:len(df.index)]
+        if Intmode=='max':
+            Int=Ints.max(axis=1)
+        elif Intmode=='ave':
+            Int=Ints.mean(axis=1)
+        else:
+            raise ValueError("Intmode not allowed")
+        RTs = df.iloc[:,2].to_numpy(dtype=float)
+        X = Ints.to_numpy(dtype=float,na_value=numpy.nan)
+        blocks = _rt_blocks(RTs,RTwin) if ncores>1 else []
+        if len(blocks)>1:
+            rels = _pool_map(ncores,pool,_cluster_block,(Cthr,RTwin,Corrmode,memlimit,tmpdir),
+                             [(X[ind,:],RTs[ind]) for ind in blocks])
+            rel = _stitch_blocks(blocks,rels)
+        else:
+            rel = _cluster_block(Cthr,RTwin,Corrmode,memlimit,tmpdir,(X,RTs))
+        df = _cluster_table(df,Int,rel)
+        end = time.time()
+        print(round(end - start,1), 'seconds elapsed')
+        return(df)
     ids = list(df.iloc[:,0])
     mzs=list(df.iloc[:,1])
     RTs=list(df.iloc[:,2])
@@ -91,8 +174,271 @@ def clusterFeatures(df,Cthr=0.8,RTwin=1,Intmode='max'):
     return(df)
 
 
+def _cluster_block(Cthr,RTwin,Corrmode,memlimit,tmpdir,block):
+    """
+    Clusters a set of features (see clusterFeatures()).
+
+    Parameters
+    ----------
+    Cthr: minimum correlation allowed in each cluster
+    RTwin: maximum difference in RT time between features in the same cluster
+    Corrmode: either 'full', 'window' or 'blocked'
+    memlimit: approximate memory (in MB) used when Corrmode='blocked'
+    tmpdir: directory used when Corrmode='blocked'
+    block: tuple with the intensities (features x samples) and the RTs of the
+           features
+
+    Returns
+    -------
+    rel: numpy array with the relation id assigned to each feature
+    """
+    X, RTs = block
+    if Corrmode=='full':
+        CorrInts = pandas.DataFrame(X).transpose().corr().to_numpy()
+        rel = _greedy_clusters(CorrInts,RTs,Cthr,RTwin)
+    elif Corrmode=='window':
+        CorrInts = _window_corr(X,RTs,Cthr,RTwin)
+        rel = _greedy_clusters_sparse(CorrInts)
+    else:
+        CorrInts, path = _blocked_corr(X,RTs,RTwin,memlimit,tmpdir)
+        try:
+            rel = _greedy_clusters(CorrInts,RTs,Cthr,RTwin)
+        finally:
+            del CorrInts
+            os.remove(path)
+    return(rel)
+
+
+def _rt_blocks(RTs,RTwin):
+    """
+    Splits the features in blocks wherever two consecutive RTs are more than
+    RTwin apart. Features in different blocks can never be in the same
+    cluster.
+
+    Returns
+    -------
+    blocks: list of numpy arrays containing the (sorted) indices of the
+            features in each block
+    """
+    order = numpy.argsort(RTs,kind='stable')
+    cuts = numpy.flatnonzero(numpy.diff(RTs[order])>RTwin)+1
+    blocks = [numpy.sort(ind) for ind in numpy.split(order,cuts)]
+    return(blocks)
+
+
+def _stitch_blocks(blocks,rels):
+    """
+    Merges the relation ids computed independently for each block into
+    globally unique relation ids. Clusters are numbered by the position of
+    their seed in the original table, as when clustering all features at once.
+    """
+    n = sum(len(ind) for ind in blocks)
+    seeds = []
+    for ind, rel in zip(blocks,rels):
+        seeds.append(ind[numpy.unique(rel,return_index=True)[1]])
+    offsets = numpy.cumsum([0]+[len(v) for v in seeds])
+    rank = numpy.argsort(numpy.argsort(numpy.concatenate(seeds),kind='stable'),kind='stable')
+    out = numpy.zeros(n,dtype=numpy.int64)
+    for b in range(0,len(blocks)):
+        out[blocks[b]] = rank[offsets[b]+rels[b]]
+    return(out)
+
+
+def _greedy_clusters(CorrInts,RTs,Cthr,RTwin):
+    """
+    Greedy clustering used by clusterFeatures(). The first feature not yet
+    assigned is used as seed and all the unassigned features correlated with
+    it (>=Cthr) and within RTwin are assigned to the same cluster.
+
+    Parameters
+    ----------
+    CorrInts: square array (or memory-mapped array) with the correlations
+              between features, in the same order as RTs
+    RTs: numpy array with the retention times of the features
+    Cthr: minimum correlation allowed in each cluster
+    RTwin: maximum difference in RT time between features in the same cluster
+
+    Returns
+    -------
+    rel: numpy array with the relation id assigned to each feature
+    """
+    n = len(RTs)
+    unassigned = numpy.ones(n,dtype=bool)
+    rel = numpy.zeros(n,dtype=numpy.int64)
+    rid = 0
+    for seed in range(0,n):
+        if not unassigned[seed]:
+            continue
+        ind = unassigned & (numpy.abs(RTs-RTs[seed])<=RTwin)
+        ind &= numpy.asarray(CorrInts[seed,:])>=Cthr
+        ind[seed] = True # the seed is always part of its own cluster
+        rel[ind] = rid
+        unassigned[ind] = False
+        rid = rid+1
+    return(rel)
+
 
-def map_isotope_patterns(df,isoDiff=1, ppm=100, ionisation=1,MinIsoRatio=.5):
+def _greedy_clusters_sparse(CorrInts):
+    """
+    Same as _greedy_clusters() but using the sparse matrix computed by
+    _window_corr(), which only contains the pairs of features that can be
+    part of the same cluster.
+
+    Parameters
+    ----------
+    CorrInts: scipy.sparse csr matrix, output of _window_corr()
+
+    Returns
+    -------
+    rel: numpy array with the relation id assigned to each feature
+    """
+    n = CorrInts.shape[0]
+    indptr = CorrInts.indptr
+    indices = CorrInts.indices
+    unassigned = numpy.ones(n,dtype=bool)
+    rel = numpy.zeros(n,dtype=numpy.int64)
+    rid = 0
+    for seed in range(0,n):
+        if not unassigned[seed]:
+            continue
+        ind = indices[indptr[seed]:indptr[seed+1]]
+        ind = ind[unassigned[ind]]
+        rel[ind] = rid
+        rel[seed] = rid
+        unassigned[ind] = False
+        unassigned[seed] = False
+        rid = rid+1
+    return(rel)
+
+
+def _window_corr(X,RTs,Cthr,RTwin,block=256):
+    """
+    Computes the correlations between features only for the pairs of features
+    within RTwin. Features are sorted by RT and processed in blocks of rows,
+    each block being compared with the features in its RT window.
+
+    Parameters
+    ----------
+    X: numpy array (features x samples) with the intensities
+    RTs: numpy array with the retention times of the features
+    Cthr: minimum correlation allowed in each cluster
+    RTwin: maximum difference in RT time between features in the same cluster
+    block: number of features processed at the same time
+
+    Returns
+    -------
+    CorrInts: symmetric scipy.sparse csr matrix containing the correlations
+              >=Cthr between features closer than RTwin, in the original
+              order of the features
+    """
+    n = len(RTs)
+    order = numpy.argsort(RTs,kind='stable')
+    rts = RTs[order]
+    Xs = X[order,:]
+    nanrows = numpy.isnan(Xs).any(axis=1)
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        Z = Xs-Xs.mean(axis=1,keepdims=True)
+        Z = Z/numpy.sqrt((Z**2).sum(axis=1,keepdims=True))
+    rows = []
+    cols = []
+    vals = []
+    for a in range(0,n,block):
+        b = min(a+block,n)
+        e = numpy.searchsorted(rts,numpy.nextafter(rts[b-1]+RTwin,numpy.inf),
+                               side='right')
+        if nanrows[a:e].any():
+            ### pairwise complete observations, as in pandas
+            C = pandas.DataFrame(Xs[a:e,:]).transpose().corr().to_numpy()[0:(b-a),:]
+        else:
+            C = Z[a:b,:] @ Z[a:e,:].T
+        keep = (C>=Cthr) & (numpy.abs(rts[None,a:e]-rts[a:b,None])<=RTwin)
+        i,j = numpy.nonzero(keep)
+        sel = j>i
+        rows.append(order[i[sel]+a])
+        cols.append(order[j[sel]+a])
+        vals.append(C[i[sel],j[sel]])
+    rows = numpy.concatenate(rows) if len(rows)>0 else numpy.zeros(0,dtype=numpy.int64)
+    cols = numpy.concatenate(cols) if len(cols)>0 else numpy.zeros(0,dtype=numpy.int64)
+    vals = numpy.concatenate(vals) if len(vals)>0 else numpy.zeros(0)
+    CorrInts = sparse.coo_matrix((vals,(rows,cols)),shape=(n,n)).tocsr()
+    CorrInts = CorrInts+CorrInts.T
+    CorrInts.sort_indices()
+    return(CorrInts)
+
+
+def _blocked_corr(X,RTs,RTwin,memlimit=1024,tmpdir=None):
+    """
+    Computes the correlation matrix in float32 tiles and writes it to a
+    memory-mapped file. Intensities are z-scored once, so that each tile is a
+    single matrix product. Tiles are built on the features sorted by RT, so
+    that tiles containing only pairs of features more than RTwin apart can be
+    skipped (left to 0), since they can never be part of the same cluster.
+
+    Parameters
+    ----------
+    X: numpy array (features x samples) with the intensities
+    RTs: numpy array with the retention times of the features
+    RTwin: maximum difference in RT time between features in the same cluster
+    memlimit: approximate memory (in MB) used for the tiles
+    tmpdir: directory where the memory-mapped file is written. If None the
+            system temporary directory is used
+
+    Returns
+    -------
+    CorrInts: numpy memmap (features x features) containing the correlations
+    path: path of the memory-mapped file. It is up to the caller to remove it
+    """
+    n = len(RTs)
+    tile = max(1,int(math.sqrt(memlimit*(2**20)/(4*3))))
+    order = numpy.argsort(RTs,kind='stable')
+    rts = RTs[order]
+    Xs = X[order,:]
+    nanrows = numpy.isnan(Xs).any(axis=1)
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        Z = (Xs-Xs.mean(axis=1,keepdims=True)).astype(numpy.float32)
+        Z = Z/numpy.sqrt((Z**2).sum(axis=1,keepdims=True))
+    fd, path = tempfile.mkstemp(suffix='.corr',dir=tmpdir)
+    os.close(fd)
+    CorrInts = numpy.memmap(path,dtype=numpy.float32,mode='w+',shape=(n,n))
+    for a in range(0,n,tile):
+        b = min(a+tile,n)
+        for c in range(a,n,tile):
+            d = min(c+tile,n)
+            if rts[c]-rts[b-1]>RTwin:
+                ### rts is sorted: all the following tiles are further apart
+                break
+            if nanrows[a:b].any() or nanrows[c:d].any():
+                ### pairwise complete observations, as in pandas
+                C = pandas.DataFrame(numpy.vstack([Xs[a:b,:],Xs[c:d,:]])).transpose().corr()
+                C = C.to_numpy(dtype=numpy.float32)[0:(b-a),(b-a):]
+            else:
+                C = Z[a:b,:] @ Z[c:d,:].T
+            ### tiles are written back in the original order of the features
+            CorrInts[numpy.ix_(order[a:b],order[c:d])] = C
+            if c!=a:
+                CorrInts[numpy.ix_(order[c:d],order[a:b])] = C.T
+        CorrInts.flush()
+    return(CorrInts,path)
+
+
+def _cluster_table(df,Int,rel):
+    """
+    Builds the output of clusterFeatures() from the relation ids found for
+    each feature. Features are reported cluster by cluster, keeping their
+    original order within each cluster.
+    """
+    order = numpy.argsort(rel,kind='stable')
+    out = pandas.DataFrame({'ids':df.iloc[order,0].to_numpy(),
+                            'rel.ids':rel[order],
+                            'mzs':df.iloc[order,1].to_numpy(),
+                            'RTs':df.iloc[order,2].to_numpy(),
+                            'Int':numpy.asarray(Int)[order]})
+    return(out)
+
+
+
+def map_isotope_patterns(df,isoDiff=1, ppm=100, ionisation=1,MinIsoRatio=.5,
+                         engine='numpy',ncores=1,compact=False,pool=None):
     """
     mapping isotope patterns in MS1 data.
     
@@ -122,6 +468,24 @@ def map_isotope_patterns(df,isoDiff=1, ppm=100, ionisation=1,MinIsoRatio=.5):
     MinIsoRatio: mininum intensity ratio expressed (Default value 1%). Only
                 isotopes with intensity higher than MinIsoRatio% of the main isotope
                 are considered.
+    engine: Defines how isotopes are matched within each relation id. If
+            'numpy' (default) the features are grouped by rel.id once, the mzs
+            are sorted once per group and the isotopes for all charges are
+            found with numpy.searchsorted. If 'legacy' the original
+            implementation is used. Both give the same results.
+    ncores: default value 1. Number of cores used (only if engine='numpy').
+            Relation ids are independent, so they are distributed across the
+            cores.
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1).
+          If None, a new pool is created for this call only.
+    compact: default value False. If True, the columns added are stored with
+             compact types: relationship as a pandas Categorical, isotope
+             pattern as nullable Int32 and charge as nullable Int8 (missing
+             values are pandas.NA instead of None). The annotation functions
+             accept both representations. With engine='batch' the compact
+             columns are read directly; the other engines work on a copy with
+             object columns, as expected by the iteration functions.
     
     Returns
     -------
@@ -138,9 +502,34 @@ def map_isotope_patterns(df,isoDiff=1, ppm=100, ionisation=1,MinIsoRatio=.5):
         - charge: predicted charge based on the isotope pattern (1,2,3,4,5 or
                   -1,-2,-3,-4,-5 are the only values allowed)
     """
+    if engine not in ['numpy','legacy']:
+        raise ValueError("engine not allowed")
+    if ncores<1:
+        raise ValueError("ncores must be >=1")
+    if engine=='legacy' and ncores>1:
+        raise ValueError("ncores>1 can only be used with engine='numpy'")
     print("mapping isotope patterns ....")
     start = time.time()
-    if isinstance(df, pandas.DataFrame):
+    if isinstance(df, pandas.DataFrame) and engine=='numpy':
+        groups = list(df.groupby(df.iloc[:,1],sort=False).indices.values())
+        mzs = df.iloc[:,2].to_numpy(dtype=float)
+        Ints = df.iloc[:,4].to_numpy(dtype=float)
+        data = [(mzs[ind],Ints[ind]) for ind in groups]
+        if ncores>1:
+            data = _pool_map(ncores,pool,_isotope_group,(isoDiff,ppm,ionisation,MinIsoRatio),data)
+        else:
+            data = [_isotope_group(isoDiff,ppm,ionisation,MinIsoRatio,v) for v in data]
+        rels = numpy.full(len(df.index),None,dtype=object)
+        pats = numpy.full(len(df.index),None,dtype=object)
+        chs = numpy.full(len(df.index),None,dtype=object)
+        for ind, res in zip(groups,data):
+            rels[ind] = res[0]
+            pats[ind] = res[1]
+            chs[ind] = res[2]
+        df['relationship'] = rels
+        df['isotope pattern'] = pats
+        df['charge'] = chs
+    elif isinstance(df, pandas.DataFrame):
         relIds = df.iloc[:,1]
         relIds = list(set(relIds))
         df['relationship'] = [None] * len(df.index)
@@ -250,11 +639,302 @@ def map_isotope_patterns(df,isoDiff=1, ppm=100, ionisation=1,MinIsoRatio=.5):
         df.drop(columns=['ind'],inplace=True)
     else:
         raise Exception("""'map_isotope_patterns' method can only be applied to pandas dataframe.""")
+    if compact:
+        _compact_columns(df)
     end = time.time()
     print(round(end - start,1), 'seconds elapsed')
 
 
-def compute_all_adducts(adductsAll, DB, ionisation=1, ncores=1):
+def _isotope_group(isoDiff,ppm,ionisation,MinIsoRatio,group):
+    """
+    Maps the isotope patterns within a single relation id (see
+    map_isotope_patterns()).
+
+    Parameters
+    ----------
+    isoDiff: difference between isotopes of charge 1
+    ppm: maximum ppm value allowed between 2 isotopes
+    ionisation: positive = 1, negative = -1
+    MinIsoRatio: mininum intensity ratio expressed (%)
+    group: tuple with the mzs and the intensities of the features in the
+           relation id
+
+    Returns
+    -------
+    rels, pats, chs: lists with the relationship, isotope pattern and charge
+                     of each feature, in the same order as in group
+    """
+    mzs, Ints = group
+    order = numpy.argsort(mzs,kind='quicksort') # same order as sort_values()
+    mzs = mzs[order]
+    Ints = Ints[order]
+    charge, partners = _isotope_matches(mzs,isoDiff,ppm)
+    rels, pats, chs = _isotope_chains(charge,partners,ionisation)
+    ##fix isotope patterns
+    pats_arr = numpy.array([-1 if v is None else v for v in pats])
+    indfout = []
+    for p in set(pats_arr[pats_arr>=0].tolist()):
+        indp = numpy.flatnonzero(pats_arr==p)
+        Intp = Ints[indp]
+        ratios_iso = (Intp/max(Intp))*100
+        indfout.extend(indp[ratios_iso<=MinIsoRatio].tolist())
+        for v in indp:
+            rels[v] = "potential bp|isotope"
+        rels[indp[numpy.argmax(Intp==max(Intp))]] = "potential bp"
+    #find basepeaks
+    indbp = int(numpy.argmax(Ints==max(Ints)))
+    if pats[indbp] is not None:
+        for v in numpy.flatnonzero(pats_arr==pats[indbp]):
+            rels[v] = "bp|isotope"
+    rels[indbp] = "bp"
+    for v in indfout:
+        rels[v] = None
+        pats[v] = None
+        chs[v] = None
+    inv = numpy.empty(len(order),dtype=numpy.int64)
+    inv[order] = numpy.arange(0,len(order))
+    return([rels[v] for v in inv],[pats[v] for v in inv],[chs[v] for v in inv])
+
+
+def _isotope_matches(mzs,isoDiff,ppm):
+    """
+    Finds the possible isotopes of each feature within a relation id.
+
+    Parameters
+    ----------
+    mzs: numpy array with the mzs of the features, in ascending order
+    isoDiff: difference between isotopes of charge 1
+    ppm: maximum ppm value allowed between 2 isotopes
+
+    Returns
+    -------
+    charge: numpy array with, for each feature, the highest charge (1 to 5)
+            for which at least one isotope was found (0 if none). The last
+            feature is never considered, as in the original implementation.
+    partners: list with, for each feature, the indices of the isotopes found
+              for that charge
+    """
+    m = len(mzs)
+    charge = numpy.zeros(m,dtype=numpy.int64)
+    partners = [None]*m
+    if m<2:
+        return(charge,partners)
+    K = numpy.arange(0,m-1)
+    tol = ppm/(10**6)
+    for z in range(1,6): ### higher charges take precedence over lower ones
+        t = mzs[K]+(isoDiff/z)
+        margin = numpy.abs(t)*(tol*(1+1e-9)+1e-12)
+        lo = numpy.searchsorted(mzs,t-margin,side='left')
+        hi = numpy.searchsorted(mzs,t+margin,side='right')
+        n = hi-lo
+        kk = numpy.repeat(K,n)
+        jj = numpy.arange(0,n.sum())-numpy.repeat(numpy.cumsum(n)-n,n)+numpy.repeat(lo,n)
+        ok = (numpy.abs(((mzs[jj]-t[kk])/t[kk])*(10**6))<=ppm) & (jj!=kk)
+        kk = kk[ok]
+        jj = jj[ok]
+        found = numpy.bincount(kk,minlength=m-1)
+        splits = numpy.split(jj,numpy.cumsum(found)[:-1])
+        for k in numpy.flatnonzero(found):
+            charge[k] = z
+            partners[k] = splits[k]
+    return(charge,partners)
+
+
+def _isotope_chains(charge,partners,ionisation):
+    """
+    Groups the isotopes found by _isotope_matches() into isotope patterns,
+    going through the features in ascending mz order.
+
+    Returns
+    -------
+    rels: list with "isotope" or None for each feature
+    pats: list with the isotope pattern of each feature (or None)
+    chs: list with the charge of each feature (or None)
+    """
+    m = len(charge)
+    rels = [None]*m
+    pats = [None]*m
+    chs = [None]*m
+    c = 0
+    f1 = False
+    f2 = False
+    for k in range(0,m-1):
+        z = int(charge[k])
+        if z>0:
+            for v in [k]+partners[k].tolist():
+                rels[v] = "isotope"
+                pats[v] = c
+                chs[v] = z*ionisation
+            f2 = True
+        else:
+            f1 = rels[k]!=None
+        if f1 and f2:
+            c = c+1
+            f1 = False
+            f2 = False
+    return(rels,pats,chs)
+
+
+def _compact_columns(df):
+    """
+    Stores the relationship, isotope pattern and charge columns added by
+    map_isotope_patterns() with compact types (in place).
+    """
+    df[df.columns[5]] = pandas.Categorical(df.iloc[:,5],categories=['bp','bp|isotope',
+                                                                    'potential bp',
+                                                                    'potential bp|isotope'])
+    df[df.columns[6]] = pandas.array(df.iloc[:,6].tolist(),dtype='Int32')
+    df[df.columns[7]] = pandas.array(df.iloc[:,7].tolist(),dtype='Int8')
+
+
+def _object_columns(df):
+    """
+    Returns df with the relationship, isotope pattern and charge columns
+    stored as objects with None for missing values, as expected by the
+    iteration functions. df is returned unchanged if the columns are already
+    objects.
+    """
+    cols = [c for c in df.columns[5:8] if df[c].dtype!=object]
+    if len(cols)>0:
+        df = df.copy()
+        for c in cols:
+            df[c] = _object_values(df[c])
+    return(df)
+
+
+def _object_values(col):
+    """
+    Values of a column as a numpy object array with None for missing values,
+    as stored by _object_columns(), so that the compact columns can be read
+    without converting the whole table.
+    """
+    if col.dtype==object:
+        return(col.to_numpy())
+    return(col.astype(object).where(col.notna(),None).to_numpy())
+
+
+def _ann_index(df):
+    """
+    Returns the sorted positions of the features to annotate, i.e. those
+    labelled as 'bp' or 'potential bp' and those without relationship.
+    """
+    rel = df.iloc[:,5]
+    if isinstance(rel.dtype,pandas.CategoricalDtype):
+        sel = rel.isin(['bp','potential bp']).to_numpy() | rel.isna().to_numpy()
+    else:
+        rel = rel.to_numpy(dtype=object)
+        sel = (rel=='bp') | (rel=='potential bp') | numpy.equal(rel,None)
+    return(numpy.flatnonzero(sel).tolist())
+
+
+_formulas = collections.OrderedDict()
+
+def _formula_entry(formula):
+    """
+    Returns the entry of the formula service for formula, parsing it with
+    molmass only if it is not already stored. The least recently used
+    formulas are dropped when more than FORMULA_CACHE_SIZE are stored.
+    """
+    entry = _formulas.get(formula)
+    if entry is None:
+        f = molmass.Formula(formula)
+        comp = f.composition()
+        if hasattr(comp,'values'):
+            comp = comp.values()
+        elements = []
+        for item in comp:
+            ### symbols are given as e.g. 'C' or '13C' for isotopes
+            n, e = re.match(r'^(\d*)(\D+)$',item[0]).groups()
+            elements.append(((e,int(n) if n else 0),int(item[1])))
+        entry = {'formula':f.formula, 'mass':f.isotope.mass,
+                 'elements':tuple(elements), 'spectrum':None}
+        _formulas[formula] = entry
+        while len(_formulas)>FORMULA_CACHE_SIZE:
+            _formulas.popitem(last=False)
+    else:
+        _formulas.move_to_end(formula)
+    return(entry)
+
+
+def formula_mass(formula):
+    """
+    Monoisotopic mass of a formula (molmass.Formula(formula).isotope.mass).
+    The formula service keeps the results of molmass for the most recently
+    used formulas, so that formulas shared by different compounds (e.g.,
+    isomers) or by different functions are parsed only once per process.
+    """
+    return(_formula_entry(formula)['mass'])
+
+
+def formula_hill(formula):
+    """
+    Formula in Hill notation (molmass.Formula(formula).formula), see
+    formula_mass().
+    """
+    return(_formula_entry(formula)['formula'])
+
+
+def formula_elements(formula):
+    """
+    Element counts of a formula as a tuple of ((symbol, massnumber), count)
+    pairs, with massnumber 0 for the natural isotopic composition. See
+    formula_mass().
+    """
+    return(_formula_entry(formula)['elements'])
+
+
+def formula_spectrum(formula):
+    """
+    Isotope envelope of a formula (molmass.Formula(formula).spectrum()) as a
+    numpy array with one row for each isotopologue containing its mass and
+    its fraction. See formula_mass().
+    """
+    entry = _formula_entry(formula)
+    if entry['spectrum'] is None:
+        spectrum = molmass.Formula(formula).spectrum()
+        entry['spectrum'] = numpy.array(list(spectrum.values()),dtype=float)
+    return(entry['spectrum'].copy())
+
+
+def save_formula_cache(path):
+    """
+    Saves the formulas currently stored by the formula service to a json
+    file, so that they can be loaded by load_formula_cache() in another
+    session. If the environment variable IPA_FORMULA_CACHE points to such a
+    file, it is loaded when ipa is imported (including in the worker
+    processes).
+    """
+    data = []
+    for formula, entry in _formulas.items():
+        spectrum = entry['spectrum']
+        data.append([formula,{'formula':entry['formula'],'mass':entry['mass'],
+                              'elements':[[e,n,c] for (e,n),c in entry['elements']],
+                              'spectrum':None if spectrum is None else spectrum.tolist()}])
+    with open(path,'w') as f:
+        json.dump(data,f)
+
+
+def load_formula_cache(path):
+    """
+    Loads the formulas saved by save_formula_cache() into the formula service.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    for formula, entry in data:
+        spectrum = entry['spectrum']
+        _formulas[formula] = {'formula':entry['formula'],'mass':entry['mass'],
+                              'elements':tuple(((e,n),c) for e,n,c in entry['elements']),
+                              'spectrum':None if spectrum is None else numpy.array(spectrum,dtype=float)}
+    while len(_formulas)>FORMULA_CACHE_SIZE:
+        _formulas.popitem(last=False)
+
+
+if os.environ.get('IPA_FORMULA_CACHE') and os.path.exists(os.environ['IPA_FORMULA_CACHE']):
+    load_formula_cache(os.environ['IPA_FORMULA_CACHE'])
+
+
+def compute_all_adducts(adductsAll, DB, ionisation=1, ncores=1, engine='numpy',
+                        cachedir=None, pool=None):
     """
     compute all adducts table based on the information present in the database
     
@@ -289,14 +969,44 @@ def compute_all_adducts(adductsAll, DB, ionisation=1, ncores=1):
              - reactions: list of reactions ids involving this compound
                           (e.g., 'R00010 R00015 R00028')-optional 
     ionisation : Default value 1. positive = 1, negative = -1
-    ncores : default value 1. Number of cores used
+    ncores : default value 1. Number of cores used (only if engine='legacy')
+    engine : Defines how the adducts table is computed. If 'numpy' (default)
+             each formula and each adduct definition is parsed only once and
+             all the m/z values and formulas are computed with numpy over a
+             compound x adduct mask. If 'legacy' the original implementation
+             (one iteration per database entry) is used. Both give the same
+             results.
+    pool : default value None. Pool of worker processes created with
+           worker_pool() and shared with other calls (only used if ncores>1).
+           If None, a new pool is created for this call only.
+    cachedir : default value None. If provided, the table is loaded from the
+               disk cache in this directory when the same DB, adducts and
+               ionisation were already used, otherwise it is computed and
+               stored there (see clear_cache()).
     
     Returns
     -------
     allAdds: pandas dataframe containing the information on all the possible
     adducts given the database.
     """
-    if ncores==1:
+    if engine not in ['numpy','legacy']:
+        raise ValueError("engine not allowed")
+    if cachedir is not None:
+        key = _cache_key('allAdds',adductsAll,DB,ionisation)
+        allAdds = _cache_load(cachedir,key)
+        if allAdds is not None:
+            print("all adducts loaded from cache")
+            return(allAdds)
+    if engine=='numpy':
+        if ncores<1:
+            raise ValueError("ncores must be >=1")
+        print("computing all adducts ....")
+        start = time.time()
+        DB = DB.replace(numpy.nan,None)
+        allAdds = _all_adducts(adductsAll,DB,ionisation)
+        end = time.time()
+        print(round(end - start,1), 'seconds elapsed')
+    elif ncores==1:
         print("computing all adducts ....")
         start = time.time()
         DB = DB.replace(numpy.nan,None)
@@ -311,15 +1021,99 @@ def compute_all_adducts(adductsAll, DB, ionisation=1, ncores=1):
         print("computing all adducts - Parallelized ....")
         start = time.time()
         DB = DB.replace(numpy.nan,None)
-        pool_obj = multiprocessing.Pool(ncores)
-        data = pool_obj.map(partial(iterations.all_adducts_iter,DB,adductsAll,ionisation),range(0,len(DB.index)))
-        pool_obj.terminate()
+        data = _pool_map(ncores,pool,iterations.all_adducts_iter,(DB,adductsAll,ionisation),
+                         range(0,len(DB.index)))
         allAdds =pandas.concat(data,ignore_index=True)
         allAdds.columns=['id','name','adduct','formula','charge','m/z','RT','pk','MS2']
         end = time.time()
         print(round(end - start,1), 'seconds elapsed')
     else:
         raise ValueError("ncores must be >=1")
+    if cachedir is not None:
+        _cache_store(cachedir,key,allAdds)
+    return(allAdds)
+
+
+def _all_adducts(adductsAll,DB,ionisation):
+    """
+    Computes the all adducts table (see compute_all_adducts()) with numpy.
+    Rows are in the same order as in the legacy implementation: database
+    entries first, then the order of the adducts in adductsAll.
+    """
+    if ionisation==1:
+        adds = DB['adductsPos']
+    else:
+        adds = DB['adductsNeg']
+    names = adductsAll['name'].tolist()
+    # compound x adduct mask, computed once for each distinct list of adducts.
+    # The last row (no adducts) is used for entries with a missing list
+    codes, lists = pandas.factorize(adds)
+    masks = numpy.zeros((len(lists)+1,len(names)),dtype=bool)
+    for i,l in enumerate(lists):
+        l = set(l.split(';'))
+        masks[i,:] = [n in l for n in names]
+    ic, ja = numpy.nonzero(masks[codes,:])
+
+    # each formula and each adduct definition is parsed once and stored as a
+    # vector of element counts
+    fcodes, forms = pandas.factorize(DB['formula'])
+    M = numpy.array([formula_mass(f) for f in forms])
+    hasadd = (adductsAll.iloc[:,6] != 'FALSE').to_numpy()
+    hasded = (adductsAll.iloc[:,7] != 'FALSE').to_numpy()
+    forms = [formula_elements(f) for f in forms]
+    fadd = [formula_elements(f) if h else () for f,h in zip(adductsAll.iloc[:,6],hasadd)]
+    fded = [formula_elements(f) if h else () for f,h in zip(adductsAll.iloc[:,7],hasded)]
+    elements = {}
+    for f in forms+fadd+fded:
+        for e,c in f:
+            elements.setdefault(e,len(elements))
+
+    def counts(fs):
+        C = numpy.zeros((len(fs),len(elements)),dtype=numpy.int64)
+        for i,f in enumerate(fs):
+            for e,c in f:
+                C[i,elements[e]] = c
+        return(C)
+
+    C = counts(forms)
+    A = counts(fadd)
+    D = counts(fded)
+
+    #m/z
+    charge = adductsAll.iloc[:,2].to_numpy()
+    mult = adductsAll.iloc[:,3].to_numpy()
+    mass = adductsAll.iloc[:,4].to_numpy()
+    mzs = ((M[fcodes[ic]]/numpy.abs(charge[ja]))*mult[ja])+mass[ja]
+
+    #formulas, computed for each distinct formula/adduct pair. The molecule is
+    #multiplied by Multi before adding Formula_add and again before deducting
+    #Formula_ded, and the deduction is only done if util.check_ded() is True
+    pairs, inv = numpy.unique(fcodes[ic]*len(names)+ja,return_inverse=True)
+    pf = pairs//len(names)
+    pa = pairs%len(names)
+    Multi = numpy.ones(len(names),dtype=numpy.int64)
+    Multi[hasadd|hasded] = [int(m) for m in adductsAll.iloc[hasadd|hasded,8]]
+    V = C[pf,:]*numpy.where(hasadd[pa],Multi[pa],1)[:,None] + A[pa,:]
+    V = V*numpy.where(hasded[pa],Multi[pa],1)[:,None]
+    ded = hasded[pa] & numpy.all((V>D[pa,:]) | ((V==0) & (D[pa,:]==0)),axis=1)
+    V[ded,:] = V[ded,:] - D[pa[ded],:]
+    keys = list(elements.keys())
+    pforms = []
+    for v in V:
+        els = {}
+        for i in numpy.flatnonzero(v):
+            els.setdefault(keys[i][0],{})[keys[i][1]] = int(v[i])
+        pforms.append(molmass.from_elements(els))
+
+    allAdds = pandas.DataFrame({'id':DB['id'].to_numpy()[ic],
+                                'name':DB['name'].to_numpy()[ic],
+                                'adduct':adductsAll.iloc[:,0].to_numpy()[ja],
+                                'formula':numpy.array(pforms,dtype=object)[inv],
+                                'charge':charge[ja],
+                                'm/z':mzs,
+                                'RT':DB['RT'].to_numpy()[ic],
+                                'pk':DB['pk'].to_numpy()[ic],
+                                'MS2':DB['MS2'].to_numpy()[ic]})
     return(allAdds)
 
 
@@ -327,7 +1121,7 @@ def compute_all_adducts(adductsAll, DB, ionisation=1, ncores=1):
 
 def MS1annotation(df,allAdds,ppm,me = 5.48579909065e-04,ratiosd=0.9,
                   ppmunk=None,ratiounk=None,ppmthr=None, pRTNone=None,
-                  pRTout=None,ncores=1):
+                  pRTout=None,ncores=1,engine='batch',pool=None):
     """
     Annotation of the dataset base on the MS1 information. Prior probabilities
     are based on mass only, while post probabilities are based on mass, RT,
@@ -357,6 +1151,18 @@ def MS1annotation(df,allAdds,ppm,me = 5.48579909065e-04,ratiosd=0.9,
     pRTout: Multiplicative factor for the RT if measured RT is outside the
             RTrange present in the database. If not provided equal to 0.4
     ncores: default value 1. Number of cores used
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1).
+          If None, a new pool is created for this call only.
+    engine: Defines how the annotations are computed. If 'batch' (default)
+            the candidate annotations of all the features are scored together
+            with numpy: priors, RT, isotope pattern scores and posteriors are
+            computed as columns of a single feature x candidate table and
+            normalised per feature (ncores is not used). If 'numpy' each
+            feature is scored by iterations.MS1_ann_iter(), which only
+            receives the rows of allAdds within ppmthr, found with
+            numpy.searchsorted on allAdds sorted by m/z. If 'legacy' the whole
+            allAdds is scanned for each feature. All give the same results.
     
     Returns
     -------
@@ -365,8 +1171,32 @@ def MS1annotation(df,allAdds,ppm,me = 5.48579909065e-04,ratiosd=0.9,
                 ids for the features present in df. For each feature, the
                 annotations are summarized in a pandas dataframe.
     """
+    if engine not in ['numpy','batch','legacy']:
+        raise ValueError("engine not allowed")
     df=df.replace('None',None)
-    if ncores==1:
+    if engine!='batch':
+        df=_object_columns(df)
+    if engine=='batch' and ncores>=1:
+        print("annotating based on MS1 information....")
+        start = time.time()
+        if ppmunk is None:
+            ppmunk = ppm
+        if ppmthr is None:
+            ppmthr = 2*ppm
+        if ratiounk is None:
+            ratiounk = 0.5
+        if pRTNone is None:
+            pRTNone = 0.8
+        if pRTout is None:
+            pRTout = 0.4
+        ind = _ann_index(df)
+        sigmaln = math.sqrt(1/ratiosd)
+        data = _ann_batch(df,allAdds,ind,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln)
+        keys = list(df.iloc[ind,0])
+        annotations = dict(zip(keys, data))
+        end = time.time()
+        print(round(end - start,1), 'seconds elapsed')
+    elif ncores==1:
         print("annotating based on MS1 information....")
         start = time.time()
         if ppmunk is None:
@@ -380,12 +1210,16 @@ def MS1annotation(df,allAdds,ppm,me = 5.48579909065e-04,ratiosd=0.9,
         if pRTout is None:
             pRTout = 0.4
         annotations={}
-        ind = util.which(df.iloc[:,5]=='bp')+ util.which(df.iloc[:,5]=='potential bp') + util.whichNone(df.iloc[:,5])
-        ind.sort()
+        ind = _ann_index(df)
         sigmaln = math.sqrt(1/ratiosd)
         data=[]
-        for k in ind:
-            data.append(iterations.MS1_ann_iter(df,allAdds,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln,k))
+        if engine=='numpy':
+            index = _mz_index(allAdds)
+            for k in ind:
+                data.append(_ms1_ann_iter(df,allAdds,index,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln,k))
+        else:
+            for k in ind:
+                data.append(iterations.MS1_ann_iter(df,allAdds,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln,k))
         keys = list(df.iloc[ind,0])
         annotations = dict(zip(keys, data))
         end = time.time()
@@ -405,12 +1239,16 @@ def MS1annotation(df,allAdds,ppm,me = 5.48579909065e-04,ratiosd=0.9,
             pRTout = 0.4
         
         annotations={}
-        ind = util.which(df.iloc[:,5]=='bp')+ util.which(df.iloc[:,5]=='potential bp') + util.whichNone(df.iloc[:,5])
-        ind.sort()
+        ind = _ann_index(df)
         sigmaln = math.sqrt(1/ratiosd)
-        pool_obj = multiprocessing.Pool(ncores)
-        data = pool_obj.map(partial(iterations.MS1_ann_iter,df,allAdds,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln),ind)
-        pool_obj.terminate()
+        if engine=='numpy':
+            index = _mz_index(allAdds)
+            iter_fn = _ms1_ann_iter
+            args = (df,allAdds,index,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln)
+        else:
+            iter_fn = iterations.MS1_ann_iter
+            args = (df,allAdds,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln)
+        data = _pool_map(ncores,pool,iter_fn,args,ind)
         keys = list(df.iloc[ind,0])
         annotations = dict(zip(keys, data))
         ##convert data into dictionary! annotations[df.iloc[k,0]]=tmp
@@ -422,10 +1260,110 @@ def MS1annotation(df,allAdds,ppm,me = 5.48579909065e-04,ratiosd=0.9,
 
 
 
+def pack_spectra(spectra):
+    """
+    Parses fragmentation spectra stored as strings ('mz1:Int1 mz2:Int2 ...',
+    as in the spectrum columns of dfMS2 and DBMS2) once into packed arrays,
+    so that they do not need to be parsed again every time they are compared.
+    
+    Parameters
+    ----------
+    spectra: list (or pandas series) of spectrum strings. Missing spectra are
+             considered empty
+    
+    Returns
+    -------
+    packed: tuple (mzs,ints,offsets) of numpy arrays. The m/z values and the
+            intensities of the i-th spectrum are mzs[offsets[i]:offsets[i+1]]
+            and ints[offsets[i]:offsets[i+1]]
+    """
+    values = []
+    counts = numpy.zeros(len(spectra)+1,dtype=numpy.int64)
+    for i,sp in enumerate(spectra):
+        if isinstance(sp,str):
+            tmp = sp.replace(':',' ').split()
+            values.extend(tmp)
+            counts[i+1] = len(tmp)//2
+    values = numpy.array(list(map(float,values)),dtype=float).reshape(-1,2)
+    return((values[:,0].copy(),values[:,1].copy(),numpy.cumsum(counts)))
+
+
+def compile_ms2_library(DBMS2,path,chunksize=10000):
+    """
+    Compiles the MS2 database into a directory containing its spectra as
+    packed binary arrays (mzs.npy, ints.npy and offsets.npy, see
+    pack_spectra()) and the rest of its columns (metadata.feather, see
+    _feather_write(), so that opening a library never runs code from it). The
+    compiled library can be given to MSMSannotation() (engine='batch')
+    instead of the dataframe, so that the spectrum strings are not read and
+    parsed again in every run.
+    
+    Parameters
+    ----------
+    DBMS2: pandas dataframe containing the MS2 database, or path of the csv
+           file containing it. csv files are read chunksize rows at a time,
+           so that all the spectrum strings are never in memory at once
+    path: directory where the library is written. It is created if needed
+    chunksize: default value 10000. See DBMS2
+    
+    Returns
+    -------
+    path: directory containing the compiled library
+    """
+    print("compiling MS2 library ...")
+    start = time.time()
+    if isinstance(DBMS2, pandas.DataFrame):
+        chunks = [DBMS2]
+    else:
+        chunks = pandas.read_csv(DBMS2,chunksize=chunksize)
+    meta = []
+    mzs = []
+    ints = []
+    counts = [numpy.zeros(1,dtype=numpy.int64)]
+    for chunk in chunks:
+        m, i, o = pack_spectra(chunk['spectrum'])
+        mzs.append(m)
+        ints.append(i)
+        counts.append(numpy.diff(o))
+        meta.append(chunk.drop(columns=['spectrum']))
+    os.makedirs(path,exist_ok=True)
+    numpy.save(os.path.join(path,'mzs.npy'),numpy.concatenate(mzs))
+    numpy.save(os.path.join(path,'ints.npy'),numpy.concatenate(ints))
+    numpy.save(os.path.join(path,'offsets.npy'),numpy.cumsum(numpy.concatenate(counts)))
+    _feather_write(pandas.concat(meta,ignore_index=True),os.path.join(path,'metadata.feather'))
+    end = time.time()
+    print(round(end - start,1), 'seconds elapsed')
+    return(path)
+
+
+def load_ms2_library(path):
+    """
+    Opens an MS2 library compiled with compile_ms2_library(). The spectra are
+    memory-mapped, so they are only read from disk when used, and processes
+    using the same library share them.
+    
+    Parameters
+    ----------
+    path: directory containing the compiled library
+    
+    Returns
+    -------
+    DBMS2: pandas dataframe containing the MS2 database without the spectrum
+           column
+    library: the spectra of DBMS2 as packed arrays (see pack_spectra())
+    """
+    if not os.path.exists(os.path.join(path,'metadata.feather')):
+        raise ValueError("no compiled MS2 library in "+path+" (libraries compiled with previous versions must be compiled again)")
+    DBMS2 = _feather_read(os.path.join(path,'metadata.feather'))
+    library = tuple(numpy.load(os.path.join(path,f),mmap_mode='r') for f in ['mzs.npy','ints.npy','offsets.npy'])
+    return((DBMS2,library))
+
+
 def MSMSannotation(df,dfMS2,allAdds,DBMS2,ppm,me = 5.48579909065e-04,
                    ratiosd=0.9,ppmunk=None, ratiounk=None,ppmthr=None,
                    pRTNone=None, pRTout=None,mzdCS=0, ppmCS=10, CSunk=0.7,
-                   evfilt=False,ncores=1):
+                   evfilt=False,ncores=1,engine='batch',CSmode='pairwise',
+                   pool=None):
     """
     Annotation of the dataset base on the MS1 and MS2 information. Prior
     probabilities are based on mass only, while post probabilities are based
@@ -445,7 +1383,8 @@ def MSMSannotation(df,dfMS2,allAdds,DBMS2,ppm,me = 5.48579909065e-04,
             adducts given the database. It should be the output of either
             ipa.compute_all_adducts() or ipa.compute_all_adducts_Parallel()
     DBMS2: pandas dataframe containing the database containing the MS2
-           information
+           information, or path of the directory containing it compiled with
+           compile_ms2_library() (only if engine='batch')
     ppm: accuracy of the MS instrument used
     me: accurate mass of the electron. Default 5.48579909065e-04
     ratiosd: default 0.9. It represents the acceptable ratio between predicted
@@ -473,6 +1412,29 @@ def MSMSannotation(df,dfMS2,allAdds,DBMS2,ppm,me = 5.48579909065e-04,
     evfilt: Default value False. If true, only spectrum acquired with the same
             collision energy are considered.
     ncores: default value 1. Number of cores used
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1).
+          If None, a new pool is created for this call only.
+    CSmode: Defines how the cosine similarities are computed (only used if
+            engine='batch'). If 'pairwise' (default) each measured spectrum
+            is compared with each library spectrum in turn, with the same
+            results as MS2compare.cosine_similarity(). If 'batch' the
+            similarities between the measured spectra of a feature and the
+            library spectra of all its candidates are computed at once with
+            numpy and a sparse matrix product. The order of some floating
+            point sums changes, so the similarities agree with 'pairwise'
+            within a relative difference of 1e-12.
+    engine: Defines how the annotations are computed. If 'batch' (default)
+            the candidate annotations of all the features are scored together
+            as in MS1annotation() (ncores is not used), and the spectra in
+            dfMS2 and DBMS2 are parsed only once (see pack_spectra()) before
+            computing the cosine similarities. If 'numpy' allAdds is sorted by
+            m/z once and each feature only receives the rows within ppmthr,
+            found with numpy.searchsorted. With both, the library spectra of
+            each candidate are found in an index of DBMS2 by compound_id,
+            precursorType and collision.energy (see _library_index()). If
+            'legacy' the whole allAdds and DBMS2 are scanned for each feature.
+            All give the same results.
     
     Returns
     -------
@@ -481,9 +1443,44 @@ def MSMSannotation(df,dfMS2,allAdds,DBMS2,ppm,me = 5.48579909065e-04,
                  ids for the features present in df. For each feature, the
                  annotations are summarized in a pandas dataframe.
     """
+    if engine not in ['numpy','batch','legacy']:
+        raise ValueError("engine not allowed")
+    if CSmode not in ['pairwise','batch']:
+        raise ValueError("CSmode not allowed")
+    library = None
+    if isinstance(DBMS2, str):
+        if engine!='batch':
+            raise ValueError("compiled MS2 libraries can only be used with engine='batch'")
+        DBMS2, library = load_ms2_library(DBMS2)
     df=df.replace('None',None)
+    if engine!='batch':
+        df=_object_columns(df)
     dfMS2=dfMS2.replace('None',None)
-    if ncores==1:
+    if engine=='batch' and ncores>=1:
+        print("annotating based on MS1 and MS2 information....")
+        start = time.time()
+        if ppmunk is None:
+            ppmunk = ppm
+        if ppmthr is None:
+            ppmthr = 2*ppm
+        if ratiounk is None:
+            ratiounk = 0.5
+        if pRTNone is None:
+            pRTNone = 0.8
+        if pRTout is None:
+            pRTout = 0.4
+        ind = _ann_index(df)
+        sigmaln = math.sqrt(1/ratiosd)
+        spectra = pack_spectra(dfMS2.iloc[:,1])
+        if library is None:
+            library = pack_spectra(DBMS2['spectrum'])
+        data = _ann_batch(df,allAdds,ind,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln,
+                          (dfMS2,_library_index(DBMS2),spectra,library,mzdCS,ppmCS,CSunk,evfilt,CSmode))
+        keys = list(df.iloc[ind,0])
+        annotations = dict(zip(keys, data))
+        end = time.time()
+        print(round(end - start,1), 'seconds elapsed')
+    elif ncores==1:
         print("annotating based on MS1 and MS2 information....")
         start = time.time()
         if ppmunk is None:
@@ -497,55 +1494,1084 @@ def MSMSannotation(df,dfMS2,allAdds,DBMS2,ppm,me = 5.48579909065e-04,
         if pRTout is None:
             pRTout = 0.4
         annotations={}
-        ind = util.which(df.iloc[:,5]=='bp')+ util.which(df.iloc[:,5]=='potential bp') + util.whichNone(df.iloc[:,5])
-        ind.sort()
+        ind = _ann_index(df)
         sigmaln = math.sqrt(1/ratiosd)
         data=[]
-        for k in ind:
+        if engine=='numpy':
+            index = _mz_index(allAdds)
+            libindex = _library_index(DBMS2)
             if evfilt:
-                data.append(iterations.MSMS_ann_iter1(df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln,k))
+                iter_fn = iterations.MSMS_ann_iter1
+            else:
+                iter_fn = iterations.MSMS_ann_iter2
+            for k in ind:
+                data.append(_msms_ann_iter(iter_fn,df,dfMS2,allAdds,index,DBMS2,libindex,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln,k))
+        else:
+            for k in ind:
+                if evfilt:
+                    data.append(iterations.MSMS_ann_iter1(df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln,k))
+                else:
+                    data.append(iterations.MSMS_ann_iter2(df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln,k))
+        keys = list(df.iloc[ind,0])
+        annotations = dict(zip(keys, data))
+        end = time.time()
+        print(round(end - start,1), 'seconds elapsed')
+    elif ncores>1:
+        print("annotating based on MS1 and MS2 information - Parallelized...")
+        start = time.time()
+        if ppmunk is None:
+            ppmunk = ppm
+        if ppmthr is None:
+            ppmthr = 2*ppm
+        if ratiounk is None:
+            ratiounk = 0.5
+        if pRTNone is None:
+            pRTNone = 0.8
+        if pRTout is None:
+            pRTout = 0.4
+        annotations={}
+        ind = _ann_index(df)
+        sigmaln = math.sqrt(1/ratiosd)
+        if evfilt:
+            iter_fn = iterations.MSMS_ann_iter1
+        else:
+            iter_fn = iterations.MSMS_ann_iter2
+        if engine=='numpy':
+            index = _mz_index(allAdds)
+            args = (iter_fn,df,dfMS2,allAdds,index,DBMS2,_library_index(DBMS2),ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln)
+            iter_fn = _msms_ann_iter
+        else:
+            args = (df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln)
+        data = _pool_map(ncores,pool,iter_fn,args,ind)
+        keys = list(df.iloc[ind,0])
+        annotations = dict(zip(keys, data))
+        end = time.time()
+        print(round(end - start,1), 'seconds elapsed')
+    else:
+        raise ValueError("ncores must be >=1")
+
+    return(annotations)
+
+
+
+_worker_data = {}
+
+def _init_worker(iter_fn,args):
+    """
+    Pool initializer. Stores the iteration function and its large inputs
+    (feature table, allAdds, MS2 database, ...) once in each worker process,
+    instead of pickling them with every chunk of tasks, so that the tasks
+    only send the feature indices (see _worker_iter()). With the 'fork'
+    start method the inputs are not even copied.
+    """
+    _worker_data['iter_fn'] = iter_fn
+    _worker_data['args'] = args
+    _worker_data['path'] = None
+
+
+def _worker_iter(*k):
+    return(_worker_data['iter_fn'](*_worker_data['args'],*k))
+
+
+def _worker_file_iter(path,*k):
+    """
+    Same as _worker_iter() for the workers of a shared pool: the iteration
+    function and its inputs are read from the file written by _pool_map()
+    the first time the worker receives a task of that call, and kept until
+    a task of another call arrives.
+    """
+    if _worker_data.get('path')!=path:
+        with open(path,'rb') as f:
+            _worker_data['iter_fn'], _worker_data['args'] = pickle.load(f)
+        _worker_data['path'] = path
+    return(_worker_iter(*k))
+
+
+def worker_pool(ncores):
+    """
+    Creates a pool of worker processes that can be passed (argument pool) to
+    all the functions of a pipeline run, so that the workers are started, and
+    pandas, scipy and molmass imported in them, only once per run instead of
+    once per function. The pool must be terminated by the caller.
+    With the 'fork' start method (default on Linux) no pool is created: each
+    function then forks its own workers, which is cheap and shares the
+    inputs with the workers copy-on-write, while the workers of a shared
+    pool would each need to load their own copy of the inputs.
+    
+    Parameters
+    ----------
+    ncores: number of worker processes
+    
+    Returns
+    -------
+    pool: multiprocessing pool, or None with the 'fork' start method
+    """
+    if ncores<1:
+        raise ValueError("ncores must be >=1")
+    if multiprocessing.get_start_method()=='fork':
+        return(None)
+    return(multiprocessing.Pool(ncores,initializer=_init_worker,initargs=(None,())))
+
+
+def _pool_map(ncores,pool,iter_fn,args,tasks,star=False):
+    """
+    Computes iter_fn(*args,k) for each k in tasks (iter_fn(*args,*k) if star)
+    in parallel. If pool is None, or with the 'fork' start method, a pool of
+    ncores workers is created for this call, with the inputs stored in the
+    workers by the initializer (shared copy-on-write with 'fork'). Otherwise
+    the workers of pool are used and the inputs are written once to a
+    temporary file that each worker reads once.
+    """
+    if pool is None or multiprocessing.get_start_method()=='fork':
+        pool_obj = multiprocessing.Pool(ncores,initializer=_init_worker,initargs=(iter_fn,args))
+        if star:
+            data = pool_obj.starmap(_worker_iter,tasks)
+        else:
+            data = pool_obj.map(_worker_iter,tasks)
+        pool_obj.terminate()
+    else:
+        fd, path = tempfile.mkstemp(suffix='.pkl')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                pickle.dump((iter_fn,args),f,protocol=pickle.HIGHEST_PROTOCOL)
+            if star:
+                data = pool.starmap(partial(_worker_file_iter,path),tasks)
+            else:
+                data = pool.map(partial(_worker_file_iter,path),tasks)
+        finally:
+            os.remove(path)
+    return(data)
+
+
+def _mz_index(allAdds):
+    """
+    Sorts the m/z values in allAdds once (see _candidates()).
+    """
+    mzs = allAdds.iloc[:,5].to_numpy(dtype=float)
+    order = numpy.argsort(mzs,kind='stable')
+    return((order,mzs[order]))
+
+
+def _candidates(allAdds,index,mm,ppmthr):
+    """
+    Returns the rows of allAdds whose m/z can be within ppmthr of mm, found
+    with numpy.searchsorted on the index computed by _mz_index(). The rows are
+    kept in their original order and reindexed from 0, so that the iteration
+    functions return the same annotations as with the whole allAdds. The
+    window is slightly wider than needed, the iteration functions still apply
+    the exact ppm filter.
+    """
+    order, mzs = index
+    lo = numpy.searchsorted(mzs,(mm/(1+ppmthr*1e-6))*(1-1e-9),side='left')
+    if ppmthr<10**6:
+        hi = numpy.searchsorted(mzs,(mm/(1-ppmthr*1e-6))*(1+1e-9),side='right')
+    else:
+        hi = len(mzs)
+    return(allAdds.iloc[numpy.sort(order[lo:hi]),:].reset_index(drop=True))
+
+
+def _ms1_ann_iter(df,allAdds,index,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln,k):
+    allAdds = _candidates(allAdds,index,df.iloc[k,2],ppmthr)
+    return(iterations.MS1_ann_iter(df,allAdds,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln,k))
+
+
+def _msms_ann_iter(iter_fn,df,dfMS2,allAdds,index,DBMS2,libindex,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln,k):
+    allAdds = _candidates(allAdds,index,df.iloc[k,2],ppmthr)
+    DBMS2 = _library_rows(DBMS2,libindex,allAdds)
+    return(iter_fn(df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln,k))
+
+
+def _library_index(DBMS2):
+    """
+    Index of the MS2 library. Returns two dictionaries with the rows of DBMS2
+    (in their order) for each (compound_id,precursorType) and for each
+    (compound_id,precursorType,collision.energy), the lookups done by
+    iterations.MSMS_ann_iter2() and iterations.MSMS_ann_iter1(). Missing
+    values are not indexed, as they never match.
+    """
+    index = {}
+    index_ev = {}
+    cols = [DBMS2[c].tolist() for c in ['compound_id','precursorType','collision.energy']]
+    for r,(c,p,e) in enumerate(zip(*cols)):
+        if pandas.isna(c) or pandas.isna(p):
+            continue
+        index.setdefault((c,p),[]).append(r)
+        if not pandas.isna(e):
+            index_ev.setdefault((c,p,e),[]).append(r)
+    return((index,index_ev))
+
+
+def _library_rows(DBMS2,libindex,allAdds):
+    """
+    Rows of DBMS2 that can be used for the candidates in allAdds (in their
+    original order, see _library_index()).
+    """
+    rows = set()
+    for key in zip(allAdds['MS2'].tolist(),allAdds['adduct'].tolist()):
+        if not pandas.isna(key[0]):
+            rows.update(libindex[0].get(key,[]))
+    return(DBMS2.iloc[sorted(rows),:])
+
+
+def _seq_sum(x,starts,lens):
+    """
+    Sums of the segments x[starts[i]:starts[i]+lens[i]]. The elements are
+    added one at a time in their order, as the builtin sum() used by the
+    iteration functions does, so that the results are identical.
+    """
+    acc = numpy.zeros(len(starts))
+    for j in range(0,int(max(lens,default=0))):
+        a = lens>j
+        acc[a] = acc[a]+x[starts[a]+j]
+    return(acc)
+
+
+def _rep_sum(x,n):
+    """
+    sum([x[i]]*n[i]) for each i, see _seq_sum().
+    """
+    return(_seq_sum(numpy.repeat(x,n),numpy.cumsum(n)-n,n))
+
+
+def _ann_batch(df,allAdds,ind,ppm,me,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,sigmaln,ms2=None):
+    """
+    Scores the candidate annotations of the features in positions ind all at
+    once (engine 'batch' of MS1annotation() and MSMSannotation()). The scores
+    are computed as in iterations.MS1_ann_iter() on a table with one row for
+    each feature and candidate (plus one 'Unknown' row per feature), sorted by
+    feature and normalised per feature. If ms2 is given, the tuple
+    (dfMS2,libindex,spectra,library,mzdCS,ppmCS,CSunk,evfilt,CSmode), the
+    fragmentation pattern scores are computed by _frag_scores() and included
+    in the posteriors as in iterations.MSMS_ann_iter1() (evfilt) and
+    iterations.MSMS_ann_iter2().
+
+    Returns
+    -------
+    data: list with the annotations dataframe of each feature in ind
+    """
+    F = len(ind)
+    mm = df.iloc[ind,2].to_numpy(dtype=float)
+    rtm = df.iloc[ind,3].to_numpy(dtype=float)
+    Charge = _object_values(df.iloc[ind,7])
+    A = allAdds.iloc[:,5].to_numpy(dtype=float)
+
+    ### candidates of all features from the sorted m/z index, in the order
+    ### in which they appear in allAdds
+    order, mzs = _mz_index(allAdds)
+    lo = numpy.searchsorted(mzs,(mm/(1+ppmthr*1e-6))*(1-1e-9),side='left')
+    if ppmthr<10**6:
+        hi = numpy.searchsorted(mzs,(mm/(1-ppmthr*1e-6))*(1+1e-9),side='right')
+    else:
+        hi = numpy.full(F,len(mzs))
+    nc = hi-lo
+    fh = numpy.repeat(numpy.arange(0,F),nc)
+    rows = order[numpy.arange(0,nc.sum())-numpy.repeat(numpy.cumsum(nc)-nc,nc)+numpy.repeat(lo,nc)]
+    ppms = ((mm[fh]-A[rows])/A[rows])*(10**6)
+    keep = abs(ppms)<=ppmthr
+    fh, rows, ppms = fh[keep], rows[keep], ppms[keep]
+    srt = numpy.lexsort((rows,fh))
+    fh, rows, ppms = fh[srt], rows[srt], ppms[srt]
+
+    ### table with the hits of each feature followed by its 'Unknown' row
+    nh = numpy.bincount(fh,minlength=F)
+    fw = numpy.flatnonzero(nh>0) # features with at least one hit
+    lens = nh[fw]+1
+    starts = numpy.cumsum(lens)-lens
+    seg = numpy.cumsum(nh>0)-1
+    first = numpy.searchsorted(fh,numpy.arange(0,F))
+    ph = starts[seg[fh]]+numpy.arange(0,len(fh))-first[fh] # hit rows
+    pu = starts+lens-1 # unknown rows
+    sf = numpy.repeat(numpy.arange(0,len(fw)),lens) # segment of each row
+    N = int(lens.sum())
+
+    ### priors
+    ppm_all = numpy.zeros(N)
+    ppm_all[ph] = ppms
+    ppm_all[pu] = ppmunk
+    priors = stats.norm(0, ppm/2).pdf(ppm_all)
+    priors = priors/_seq_sum(priors,starts,lens)[sf]
+
+    ### previous knowledge
+    pks = numpy.ones(N)
+    pks[ph] = [1 if v is None else v for v in allAdds['pk'].to_numpy(dtype=object)[rows]]
+
+    ### RT scores
+    codes, ranges = pandas.factorize(allAdds.iloc[rows,6])
+    ranges = [[float(v) for v in r.split(';')] for r in ranges]
+    RTlo = numpy.array([r[0] for r in ranges]+[numpy.nan])[codes]
+    RThi = numpy.array([r[1] for r in ranges]+[numpy.nan])[codes]
+    rtin = (rtm[fh]>=RTlo) & (rtm[fh]<=RThi)
+    pRT = numpy.full(N,pRTNone,dtype=float)
+    pRT[ph] = numpy.where(codes<0,pRTNone,numpy.where(rtin,1,pRTout))
+
+    ### isotope pattern scores, only for features that are part of a pattern
+    piso = numpy.full(N,numpy.nan)
+    isoid = _object_values(df.iloc[ind,6])
+    fiso = numpy.array([isoid[f] is not None for f in fw],dtype=bool)
+    if fiso.any():
+        patterns = {}
+        for g, rind in df.groupby([df.iloc[:,1],df.iloc[:,6]]).indices.items():
+            ISm = df.iloc[rind,[2,4]].sort_values(by=[df.columns[2]])
+            patterns[g] = (ISm.iloc[:,0].to_numpy(dtype=float),
+                           (ISm.iloc[:,1]/max(ISm.iloc[:,1])).to_numpy(dtype=float))
+        relid = df.iloc[ind,1].to_numpy(dtype=object)
+        sw = numpy.flatnonzero(fiso) # segments with isotope patterns
+        ISms = [patterns[(relid[fw[i]],isoid[fw[i]])] for i in sw]
+        n = numpy.array([len(v[0]) for v in ISms])
+        nmax = int(n.max())
+        ISm_m = numpy.zeros((len(sw),nmax))
+        ISm_i = numpy.ones((len(sw),nmax))
+        for i,v in enumerate(ISms):
+            ISm_m[i,0:n[i]] = v[0]
+            ISm_i[i,0:n[i]] = v[1]
+        # hits of these features and their theoretical patterns
+        hs = numpy.flatnonzero(fiso[seg[fh]])
+        hseg = numpy.searchsorted(sw,seg[fh[hs]])
+        hn = n[hseg]
+        forms = allAdds.iloc[rows[hs],3].tolist()
+        chs = allAdds.iloc[rows[hs],4].tolist()
+        ISt_m = numpy.ones((len(hs),nmax))
+        ISt_i = numpy.ones((len(hs),nmax))
+        short = numpy.zeros(len(hs),dtype=bool)
+        first_i = numpy.zeros(len(hs))
+        theo = {}
+        for h in range(0,len(hs)):
+            key = (forms[h],chs[h],hn[h])
+            if key not in theo:
+                ISt = formula_spectrum(forms[h])
+                if len(ISt)<hn[h]:
+                    theo[key] = (True,ISt[0,1],None,None)
+                else:
+                    if chs[h]>0:
+                        m = (ISt[:,0]/abs(chs[h])) - me
+                    else:
+                        m = (ISt[:,0]/abs(chs[h])) + me
+                    o = numpy.argsort(m,kind='quicksort')[0:hn[h]]
+                    i = ISt[o,1]/max(ISt[o,1])
+                    theo[key] = (False,i[0],m[o],i)
+            short[h], first_i[h], m, i = theo[key]
+            if not short[h]:
+                ISt_m[h,0:hn[h]] = m
+                ISt_i[h,0:hn[h]] = i
+        # mass and intensity scores of the isotopes
+        ppmk = ((ISt_m-ISm_m[hseg,:])/ISt_m)*(10**6)
+        pMs = stats.norm(0, ppm/2).pdf(ppmk)/stats.norm(0, ppm/2).pdf(0)
+        ### math.exp as in the iteration functions (numpy.exp can differ in
+        ### the last digit)
+        mexp = numpy.vectorize(math.exp,otypes=[float])
+        pIs = (stats.lognorm(scale=ISt_i,s=sigmaln).pdf(ISm_i[hseg,:])/
+               stats.lognorm(scale=ISt_i,s=sigmaln).pdf(mexp(ISt_i-(sigmaln)**2)))
+        valid = numpy.arange(0,nmax)[None,:]<hn[:,None]
+        valid[:,0] = False
+        pMs = numpy.where(valid,pMs,0)
+        pIs = numpy.where(valid,pIs,0)
+        pisoM = numpy.zeros(len(hs))
+        pisoI = numpy.zeros(len(hs))
+        for j in range(1,nmax):
+            pisoM = pisoM+pMs[:,j]
+            pisoI = pisoI+pIs[:,j]
+        # different charge than the one of the pattern
+        c1 = (stats.norm(0, ppm).pdf(2*ppm)/stats.norm(0, ppm).pdf(0))
+        L = stats.lognorm(scale=first_i,s=sigmaln)
+        c2 = L.pdf(first_i+ratiounk*first_i)/L.pdf(mexp(first_i-(sigmaln)**2))
+        diff = numpy.array([c!=Charge[f] for c,f in zip(chs,fh[hs])],dtype=bool)
+        pisoM[diff] = _rep_sum(numpy.full(diff.sum(),c1/1000),hn[diff])
+        pisoI[diff] = _rep_sum(c2[diff]/1000,hn[diff])
+        pisoM[short] = 0
+        pisoI[short] = 0
+        # unknown, its intensity score uses the pattern of the last hit
+        last = numpy.searchsorted(hseg,numpy.arange(0,len(sw)),side='right')-1
+        pisoMu = _rep_sum(numpy.full(len(sw),c1),n)
+        pisoIu = _rep_sum(c2[last],n)
+        iso = numpy.zeros(N)
+        iso[ph[hs]] = pisoM
+        iso[pu[sw]] = pisoMu
+        isoI = numpy.zeros(N)
+        isoI[ph[hs]] = pisoI
+        isoI[pu[sw]] = pisoIu
+        rw = numpy.flatnonzero(fiso[sf]) # rows of these features
+        rs = numpy.searchsorted(sw,sf[rw])
+        iso = iso[rw]/_seq_sum(iso,starts[sw],lens[sw])[rs]
+        isoI = isoI[rw]/_seq_sum(isoI,starts[sw],lens[sw])[rs]
+        iso = iso*isoI
+        tot = numpy.zeros(N)
+        tot[rw] = iso
+        piso[rw] = iso/_seq_sum(tot,starts[sw],lens[sw])[rs]
+
+    ### fragmentation pattern scores
+    frag = numpy.full(N,None,dtype=object)
+    if ms2 is not None:
+        mzids = df['ids'].to_numpy(dtype=object)[ind]
+        _frag_scores(allAdds,mzids,fh,rows,fw,ph,pu,frag,*ms2)
+
+    ### posteriors
+    post = priors*numpy.where(numpy.isnan(piso),1,piso)*pks*pRT
+    if ms2 is not None:
+        CSunk = ms2[6]
+        pMS2 = numpy.array([CSunk if v is None else v for v in frag],dtype=float)
+        post = post*(pMS2/_seq_sum(pMS2,starts,lens)[sf])
+    post = post/_seq_sum(post,starts,lens)[sf]
+
+    ### annotations dataframes
+    ids = numpy.full(N,'Unknown',dtype=object)
+    names = numpy.full(N,'Unknown',dtype=object)
+    cols = {}
+    for c,j in zip(['formula','adduct','m/z','charge','RT range'],[3,2,5,4,6]):
+        cols[c] = numpy.full(N,None,dtype=object)
+        cols[c][ph] = allAdds.iloc[rows,j].to_numpy(dtype=object)
+    ids[ph] = allAdds.iloc[rows,0].to_numpy(dtype=object)
+    names[ph] = allAdds.iloc[rows,1].to_numpy(dtype=object)
+    isos = piso.astype(object)
+    isos[numpy.isnan(piso)] = None
+    ### numpy floats, as the posteriors of the iteration functions
+    posts = numpy.empty(N,dtype=object)
+    posts[:] = list(post)
+    res = pandas.DataFrame({'id':ids,'name':names,'formula':cols['formula'],
+                            'adduct':cols['adduct'],'m/z':cols['m/z'],
+                            'charge':cols['charge'],'RT range':cols['RT range'],
+                            'ppm':ppm_all,'isotope pattern score':isos,
+                            'fragmentation pattern score':frag,
+                            'prior':priors.astype(object),
+                            'post':posts})
+    data = []
+    w = 0
+    for f in range(0,F):
+        if nh[f]>0:
+            tmp = res.iloc[starts[w]:(starts[w]+lens[w]),:].sort_values(by=['post'], ascending=False)
+            w = w+1
+        else:
+            tmp=pandas.DataFrame({'id':["Unknown"],'name':["Unknown"],'formula':[None],'adduct':[None],'m/z':[None],
+                           'charge':[None],'RT range':[None],'ppm':[ppmunk],'isotope pattern score':[None],
+                           'fragmentation pattern score':[None],'prior':[1],'post':[1]})
+        tmp.index=range(0,len(tmp.index))
+        data.append(tmp)
+    return(data)
+
+
+def _frag_scores(allAdds,mzids,fh,rows,fw,ph,pu,frag,dfMS2,libindex,spectra,library,mzdCS,ppmCS,CSunk,evfilt,CSmode):
+    """
+    Fragmentation pattern scores of the hits fh/rows of _ann_batch(), written
+    in frag (rows ph for the hits and pu for the 'Unknown' of each feature),
+    as in iterations.MSMS_ann_iter1() and iterations.MSMS_ann_iter2(). The
+    library spectra of each hit are found in libindex (see _library_index())
+    and taken, as the measured ones, from the packed arrays library (DBMS2)
+    and spectra (dfMS2), see pack_spectra(). The cosine similarities of each
+    feature are computed pair by pair with _cosine() (CSmode='pairwise') or
+    all together with _cosine_batch() (CSmode='batch').
+    """
+    index, index_ev = libindex
+    measured = {}
+    for s,i in enumerate(dfMS2['id'].tolist()):
+        measured.setdefault(i,[]).append(s)
+    evs = dfMS2.iloc[:,2].to_numpy(dtype=object)
+    ms2inds = allAdds['MS2'].to_numpy(dtype=object)
+    precTypes = allAdds['adduct'].to_numpy(dtype=object)
+    first = numpy.searchsorted(fh,fw)
+    last = numpy.searchsorted(fh,fw,side='right')
+    for w in range(0,len(fw)):
+        Msps = measured.get(mzids[fw[w]])
+        hits = rows[first[w]:last[w]]
+        if Msps is None or all(v is None for v in ms2inds[hits]):
+            continue
+        frag[pu[w]] = CSunk
+        # library spectra to compare with each measured spectrum, for each hit
+        DBsps = []
+        for h in range(0,len(hits)):
+            key = (ms2inds[hits[h]],precTypes[hits[h]])
+            if pandas.isna(key[0]):
+                DBsps.append([[] for s in Msps])
+            elif evfilt:
+                DBsps.append([index_ev.get(key+(evs[s],),[]) for s in Msps])
+            else:
+                DBsps.append([index.get(key,[]) for s in Msps])
+        pairs = list(dict.fromkeys((d,s) for h in DBsps for s,DBsp in zip(Msps,h) for d in DBsp))
+        if CSmode=='batch' and len(pairs)>0:
+            cs = _cosine_batch(spectra,library,[s for d,s in pairs],[d for d,s in pairs],mzdCS,ppmCS)
+        else:
+            cs = [_cosine(*_spectrum(library,d),*_spectrum(spectra,s),mzdCS,ppmCS) for d,s in pairs]
+        cs = dict(zip(pairs,cs))
+        for h in range(0,len(hits)):
+            CS=[]
+            for s,DBsp in zip(Msps,DBsps[h]):
+                if len(DBsp)>0:
+                    CS.append(max([cs[(d,s)] for d in DBsp]))
+                else:
+                    CS.append(0.0)
+            CS = max(CS)
+            if CS==0:
+                CS=CSunk
+            frag[ph[first[w]+h]] = CS
+
+
+def _spectrum(packed,i):
+    mzs, ints, offsets = packed
+    return(mzs[offsets[i]:offsets[i+1]],ints[offsets[i]:offsets[i+1]])
+
+
+def _ranges(starts,lens):
+    """
+    Concatenation of range(starts[i],starts[i]+lens[i]) for each i.
+    """
+    return(numpy.arange(0,lens.sum())-numpy.repeat(numpy.cumsum(lens)-lens,lens)+numpy.repeat(starts,lens))
+
+
+def _cosine_batch(spectra,library,qs,ls,mzd=0,ppm=10):
+    """
+    Cosine similarities between the measured spectra qs (positions in the
+    packed arrays spectra) and the library spectra ls (positions in library),
+    one for each pair qs[i],ls[i], all computed at once. Peaks are merged and
+    binned for each pair as in _cosine() (segment operations on the peaks of
+    all pairs sorted by pair and m/z), and the dot products and norms of all
+    pairs are obtained with a single sparse matrix product. Only the order of
+    some floating point sums differs from _cosine() (and so from
+    MS2compare.cosine_similarity()): the similarities agree within a relative
+    difference of 1e-12.
+    """
+    mzq, intq, offq = spectra
+    mzl, intl, offl = library
+    qs = numpy.asarray(qs,dtype=numpy.int64)
+    ls = numpy.asarray(ls,dtype=numpy.int64)
+    P = len(ls)
+    nA = offl[ls+1]-offl[ls]
+    nB = offq[qs+1]-offq[qs]
+    # peaks of each pair (library spectrum first), sorted by pair and m/z
+    pe = numpy.concatenate((numpy.repeat(numpy.arange(0,P),nA),numpy.repeat(numpy.arange(0,P),nB)))
+    ia = _ranges(offl[ls],nA)
+    ib = _ranges(offq[qs],nB)
+    mz = numpy.concatenate((mzl[ia],mzq[ib]))
+    ints = numpy.concatenate((intl[ia],intq[ib]))
+    isA = numpy.concatenate((numpy.ones(len(ia),dtype=bool),numpy.zeros(len(ib),dtype=bool)))
+    o = numpy.lexsort((mz,pe))
+    # equal m/z values keep the order of the (unstable) sort of _cosine()
+    L = nA+nB
+    ps = numpy.cumsum(L)-L
+    ties = numpy.flatnonzero((numpy.diff(mz[o])==0) & (numpy.diff(pe[o])==0))
+    for p in numpy.unique(pe[o][ties]):
+        seg = numpy.sort(o[ps[p]:ps[p]+L[p]])
+        o[ps[p]:ps[p]+L[p]] = seg[mz[seg].astype(object).argsort(kind='quicksort')]
+    pe, mz, ints, isA = pe[o], mz[o], ints[o], isA[o]
+    cs = numpy.full(P,numpy.nan)
+    if len(mz)==0:
+        return(cs)
+    # peaks closer than the tolerance are merged
+    ps = ps[L>0]
+    thr = numpy.full(P,float(mzd))
+    if int(ppm) > 0:
+        thr[L>0] = mzd + mz[ps] * int(ppm) / 1e6
+    new = numpy.ones(len(mz),dtype=bool)
+    new[1:] = numpy.diff(mz)>=thr[pe[1:]]
+    new[ps] = True
+    gs = numpy.flatnonzero(new)
+    gl = numpy.diff(numpy.append(gs,len(mz)))
+    gp = pe[gs]
+    mz_new = numpy.add.reduceat(mz,gs)/gl
+    Int1 = numpy.add.reduceat(numpy.where(isA,ints,0.0),gs)
+    Int2 = numpy.add.reduceat(numpy.where(isA,0.0,ints),gs)
+    ng = numpy.bincount(gp,minlength=P)
+    gps = numpy.cumsum(ng)-ng
+    wp = numpy.flatnonzero(ng>0)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        Int1 = (Int1/numpy.maximum.reduceat(Int1,gps[wp])[numpy.searchsorted(wp,gp)])*100
+        Int2 = (Int2/numpy.maximum.reduceat(Int2,gps[wp])[numpy.searchsorted(wp,gp)])*100
+    # integer breaks from floor(2*min) to ceil(2*max) (one more if 2*max is
+    # an integer) and the intervals of MS2compare.findInterval(), which
+    # advance by at most one break per peak. Peaks in interval 0 end up in
+    # the last bin.
+    b0 = numpy.zeros(P,dtype=numpy.int64)
+    nbins = numpy.ones(P,dtype=numpy.int64)
+    hmax = mz_new[gps[wp]+ng[wp]-1]*2
+    b0[wp] = numpy.floor(mz_new[gps[wp]]*2)
+    nbins[wp] = numpy.ceil(hmax)-b0[wp]+(numpy.ceil(hmax)==hmax)
+    idx = numpy.zeros(len(gs),dtype=numpy.int64)
+    t = numpy.zeros(P,dtype=numpy.int64)
+    for j in range(0,int(ng.max())):
+        a = numpy.flatnonzero(ng>j)
+        g = gps[a]+j
+        t[a] = t[a]+((t[a]<=nbins[a]) & (mz_new[g]>=b0[a]+t[a]))
+        idx[g] = t[a]
+    # maximum intensity in each bin, the last interval replaces interval 0
+    rs = numpy.flatnonzero(numpy.concatenate(([True],(idx[1:]!=idx[:-1]) | (gp[1:]!=gp[:-1]))))
+    rp = gp[rs]
+    top = numpy.zeros(P,dtype=bool)
+    top[rp[idx[rs]==nbins[rp]]] = True
+    keep = ~((idx[rs]==0) & top[rp])
+    x = numpy.maximum.reduceat(Int1,rs)[keep]
+    y = numpy.maximum.reduceat(Int2,rs)[keep]
+    S = sparse.csr_matrix((numpy.ones(len(x)),(rp[keep],numpy.arange(0,len(x)))),shape=(P,len(x)))
+    dots = S @ numpy.column_stack((x*y,x*x,y*y))
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        cs[wp] = dots[wp,0]/(numpy.sqrt(dots[wp,1])*numpy.sqrt(dots[wp,2]))
+    return(cs)
+
+
+def _cosine(mz1,int1,mz2,int2,mzd=0,ppm=10):
+    """
+    Cosine similarity between the spectra (mz1,int1) and (mz2,int2), computed
+    as MS2compare.cosine_similarity() does on the corresponding strings (same
+    peak merging, binning and results), but with numpy arrays.
+    """
+    mz = numpy.concatenate((mz1,mz2))
+    ints = numpy.concatenate((int1,int2))
+    isA = numpy.arange(0,len(mz))<len(mz1)
+    # same order as sorting the object column of a dataframe
+    o = mz.astype(object).argsort(kind='quicksort')
+    mz, ints, isA = mz[o], ints[o], isA[o]
+    # peaks closer than the tolerance are merged
+    if int(ppm) > 0:
+        thr = mzd + mz[0] * int(ppm) / 1e6
+    else:
+        thr = mzd
+    new = numpy.concatenate(([True],numpy.diff(mz)>=thr))
+    starts = numpy.flatnonzero(new)
+    lens = numpy.diff(numpy.append(starts,len(mz)))
+    mz_new = _seq_sum(mz,starts,lens)/lens
+    Int_new1 = _seq_sum(numpy.where(isA,ints,0.0),starts,lens)
+    Int_new2 = _seq_sum(numpy.where(isA,0.0,ints),starts,lens)
+    Int_new1 = (Int_new1/max(Int_new1))*100
+    Int_new2 = (Int_new2/max(Int_new2))*100
+    # binning
+    holder = mz_new+mz_new
+    breaks = list(range(math.floor(min(holder)),math.ceil(max(holder))+1))
+    breaks = MS2compare.fixBreaks(breaks,[min(holder),max(holder)])
+    breaks = MS2compare.fixBreaks(breaks,[min(mz_new),max(mz_new)])
+    idx = numpy.array(MS2compare.findInterval(mz_new,breaks))
+    b = numpy.flatnonzero(numpy.concatenate(([True],idx[1:]!=idx[:-1])))
+    x = numpy.zeros(len(breaks)-1)
+    y = numpy.zeros(len(breaks)-1)
+    x[idx[b]-1] = numpy.maximum.reduceat(Int_new1,b)
+    y[idx[b]-1] = numpy.maximum.reduceat(Int_new2,b)
+    # dot product
+    mat = numpy.matmul(x,y)
+    sqrtx = math.sqrt(numpy.add.accumulate(x*x)[-1])
+    sqrty = math.sqrt(numpy.add.accumulate(y*y)[-1])
+    return(mat/(sqrtx*sqrty))
+
+
+
+def _rel_ids(df,ks):
+    rel = dict(zip(df['ids'].tolist(),df['rel.ids'].tolist()))
+    return([rel[k] for k in ks])
+
+
+def _bio_filter(annotations,Bio):
+    if len(Bio.index)==0:
+        return([])
+    all_ids = set(itertools.chain.from_iterable(a['id'].tolist() for a in annotations.values()))
+    Bio = Bio[Bio.iloc[:,0].isin(all_ids) & Bio.iloc[:,1].isin(all_ids)]
+    return(list(Bio.itertuples(index=False, name=None)))
+
+
+def _gibbs_init(annotations,ks,zs,init):
+    ids = [annotations[k]['id'].tolist() for k in ks]
+    if zs is None:
+        if init=='batch':
+            rng = numpy.random.default_rng(random.getrandbits(64))
+            ca = _categorical_draw([annotations[k]['post'].to_numpy(dtype=float) for k in ks],rng)
+        else:
+            ca = []
+            for k in ks:
+                P=list(annotations[k]['post'])
+                a_list = list(range(0,len(P)))
+                c=random.choices(a_list, P)
+                ca.append(c[0])
+    else:
+        ca = numpy.asarray(zs[len(zs)-1]).reshape(-1).tolist()
+    ca_id = [ids[i][ca[i]] for i in range(0,len(ca))]
+    return(ca, ca_id)
+
+
+class GibbsTrace(numpy.ndarray):
+    """
+    Assignments returned by the Gibbs samplers when all_out=True (iterations
+    x features). thin is the number of iterations between consecutive rows,
+    so that the rows of a thinned trace are not counted as consecutive
+    samples when the sampler is restarted from it. Selecting rows with a
+    step (e.g. zs[::10]) multiplies thin by the step; any other selection of
+    non-contiguous rows marks the result as thinned.
+    """
+    def __array_finalize__(self, obj):
+        self.thin = getattr(obj,'thin',1)
+
+    def __getitem__(self, key):
+        out = super().__getitem__(key)
+        if isinstance(out,GibbsTrace):
+            rows = key[0] if isinstance(key,tuple) and len(key)>0 else key
+            if isinstance(rows,slice):
+                if rows.step is not None and abs(rows.step)>1:
+                    out.thin = self.thin*abs(rows.step)
+            elif rows is not Ellipsis and rows is not None and not isinstance(rows,(int,numpy.integer)):
+                out.thin = max(self.thin,2)
+        return(out)
+
+
+def _gibbs_zs(zs,zs_thin=None):
+    """
+    zs as a GibbsTrace, with its thinning: zs_thin if given, the attribute
+    thin of a GibbsTrace, or the thinning stored next to the .npy file of a
+    memory-mapped zs (see _gibbs_trace()) times the step between its rows.
+    """
+    if zs is None:
+        return(None)
+    if zs_thin is None and isinstance(zs,GibbsTrace):
+        zs_thin = zs.thin
+    if zs_thin is None and isinstance(zs,numpy.memmap) and zs.filename is not None:
+        info = zs.filename+'.json'
+        if os.path.exists(info):
+            with open(info) as f:
+                zs_thin = json.load(f)['thin']
+            if zs.ndim==2 and zs.shape[1]>0:
+                zs_thin = zs_thin*max(1,abs(zs.strides[0])//(zs.itemsize*zs.shape[1]))
+    if zs_thin is None:
+        zs_thin = getattr(zs,'thin',1)
+    Z = numpy.asarray(zs).view(GibbsTrace)
+    Z.thin = int(zs_thin)
+    return(Z)
+
+
+def _gibbs_trace(lens,zs,noits,burn,stop,thin=1,keep=False,path=None):
+    """
+    Record of the samples of one chain. The samples are numbered from 0 (the
+    initial assignments, or the first row of zs when restarting from a
+    previous run). counts holds, for each candidate (slot), the number of
+    samples at positions burn..stop-1 where it was assigned. If zs was
+    thinned (see GibbsTrace), its rows are not counted and burn and stop are
+    taken from the first new sample. If keep, every thin-th sample, ending
+    with the last one, is also stored in zs, a preallocated array (samples x
+    features) that starts with the rows of the previous zs and is
+    memory-mapped to a .npy file if path is given. In this case the thinning
+    of zs is written to path+'.json', so that it is kept when the file is
+    loaded again with numpy.load(path,mmap_mode='r').
+    """
+    lens = numpy.asarray(lens,dtype=numpy.int64)
+    if zs is None:
+        L = 0
+        t1 = noits+1
+    else:
+        L = len(zs)
+        t1 = L+noits
+        if getattr(zs,'thin',1)>1:
+            burn = burn+L
+            stop = stop+L
+    trace = {'starts':numpy.cumsum(lens)-lens,'counts':numpy.zeros(int(lens.sum()),dtype=numpy.int64),
+             'burn':burn,'stop':stop,'thin':thin,'zs':None,'path':path}
+    trace['t'] = L
+    for r in range(burn,min(L,stop)):
+        trace['counts'][trace['starts']+numpy.asarray(zs[r],dtype=numpy.int64).reshape(-1)] += 1
+    if keep:
+        nnew = (t1-1-L)//thin+1 if t1>L else 0
+        if len(lens)==0 or lens.max()<=numpy.iinfo(numpy.int16).max:
+            dtype = numpy.int16
+        else:
+            dtype = numpy.int32
+        if path is None:
+            Z = numpy.zeros((L+nnew,len(lens)),dtype=dtype)
+        else:
+            Z = numpy.lib.format.open_memmap(path,mode='w+',dtype=dtype,shape=(L+nnew,len(lens)))
+        for r in range(0,L):
+            Z[r] = numpy.asarray(zs[r]).reshape(-1)
+        if path is None:
+            Z = Z.view(GibbsTrace)
+        ### if the previous rows were thinned the whole zs is taken as thinned
+        Z.thin = max(thin,getattr(zs,'thin',1)) if L>0 else thin
+        if path is not None:
+            with open(path+'.json','w') as f:
+                json.dump({'thin':int(Z.thin)},f)
+        trace['zs'] = Z
+        trace['row'] = L
+        trace['first'] = L+(t1-1-L)%thin
+    return(trace)
+
+
+def _gibbs_record(trace,ca):
+    t = trace['t']
+    if trace['burn']<=t<trace['stop']:
+        trace['counts'][trace['starts']+numpy.asarray(ca,dtype=numpy.int64)] += 1
+    if trace['zs'] is not None and t>=trace['first'] and (t-trace['first'])%trace['thin']==0:
+        trace['zs'][trace['row']] = ca
+        trace['row'] += 1
+    trace['t'] = t+1
+
+
+def _categorical_draw(P,rng):
+    lens = numpy.array([len(p) for p in P],dtype=numpy.int64)
+    if len(lens)==0:
+        return([])
+    starts = numpy.concatenate([[0],numpy.cumsum(lens)[:-1]])
+    cum = numpy.cumsum(numpy.concatenate(P))
+    base = numpy.where(starts>0,cum[starts-1],0.0)
+    total = cum[starts+lens-1]-base
+    u = base + rng.random(len(lens))*total
+    c = numpy.searchsorted(cum,u,side='right')-starts
+    return(numpy.clip(c,0,lens-1).tolist())
+
+
+def _gibbs_arrays(annotations,ks,rids=None,adjacency=None,index=None):
+    """
+    Encode the annotations into flat arrays for the 'numpy' Gibbs engine.
+    The candidates of feature i are the slots starts[i]:starts[i]+lens[i].
+    If rids is given, each slot gets the code of its (rel.id, id) pair
+    (-1 for 'Unknown'), and excl[i] is the position of the feature that
+    gibbs_sampler_add_iter() leaves out when counting the adducts connections
+    of feature i (the position equal to the key of feature i). If adjacency
+    is given, each slot gets the code of its id in the adjacency matrix and
+    the neighbours of all the slots are concatenated in nb, with weights w.
+    """
+    K = len(ks)
+    ids = [annotations[k]['id'].tolist() for k in ks]
+    lens = numpy.array([len(x) for x in ids],dtype=numpy.int64)
+    starts = numpy.cumsum(lens)-lens
+    flat = list(itertools.chain.from_iterable(ids))
+    arrays = {'K':K,'starts':starts.tolist(),'lens':lens.tolist(),
+              'post':numpy.array([p for k in ks for p in annotations[k]['post'].tolist()],dtype=float)}
+    if rids is not None:
+        groups = {}
+        keys = {}
+        key = []
+        for i in range(0,K):
+            rid = rids[i]
+            for x in ids[i]:
+                if x=='Unknown' or rid!=rid: ### NaN rel.ids are not equal to anything
+                    key.append(-1)
+                else:
+                    key.append(keys.setdefault((groups.setdefault(rid,len(groups)),x),len(keys)))
+        pos = {r:r for r in range(0,K)}
+        arrays['key'] = numpy.array(key,dtype=numpy.int64)
+        arrays['nkeys'] = len(keys)
+        arrays['excl'] = [pos.get(k,-1) for k in ks]
+    if adjacency is not None:
+        code = numpy.array([index.get(x,-1) for x in flat],dtype=numpy.int64)
+        indptr = adjacency.indptr.astype(numpy.int64)
+        nstart = numpy.where(code>=0,indptr[code],0)
+        nlen = numpy.where(code>=0,indptr[code+1]-indptr[code],0)
+        r = _ranges(nstart,nlen)
+        arrays['code'] = code
+        arrays['ncodes'] = adjacency.shape[0]
+        arrays['nb'] = adjacency.indices[r].astype(numpy.int64)
+        arrays['w'] = adjacency.data[r].astype(float)
+        arrays['off'] = numpy.concatenate([[0],numpy.cumsum(nlen)])
+    return(arrays)
+
+
+def _gibbs_counts(arrays,ca):
+    cnt_add = None
+    cnt_bio = None
+    slots = numpy.array(arrays['starts'],dtype=numpy.int64)+numpy.array(ca,dtype=numpy.int64)
+    if 'key' in arrays:
+        kk = arrays['key'][slots]
+        cnt_add = numpy.bincount(kk[kk>=0],minlength=arrays['nkeys'])
+    if 'code' in arrays:
+        cc = arrays['code'][slots]
+        cnt_bio = numpy.bincount(cc[cc>=0],minlength=arrays['ncodes'])
+    return(cnt_add, cnt_bio)
+
+
+def _gibbs_conditional(arrays,cnt_add,cnt_bio,ca,i,delta_add,delta_bio):
+    """
+    Unnormalised conditional probabilities of the candidates of feature i
+    given the current assignments ca.
+    """
+    a = arrays['starts'][i]
+    b = a+arrays['lens'][i]
+    p = arrays['post'][a:b]
+    if delta_add is not None:
+        r = arrays['excl'][i]
+        kr = -1
+        if r>=0:
+            kr = arrays['key'][arrays['starts'][r]+ca[r]]
+            if kr>=0:
+                cnt_add[kr] -= 1
+        kk = arrays['key'][a:b]
+        p_add = numpy.where(kk>=0,cnt_add[kk],0)
+        if kr>=0:
+            cnt_add[kr] += 1
+        p = p*(p_add+delta_add)
+    if delta_bio is not None:
+        cur = arrays['code'][a+ca[i]] ### without the annotation for the mass considered
+        if cur>=0:
+            cnt_bio[cur] -= 1
+        off = arrays['off'][a:b+1]
+        linked = arrays['w'][off[0]:off[-1]]*(cnt_bio[arrays['nb'][off[0]:off[-1]]]>0)
+        cs = numpy.concatenate([[0.0],numpy.cumsum(linked)])
+        p_bio = cs[off[1:]-off[0]]-cs[off[:-1]-off[0]]
+        if cur>=0:
+            cnt_bio[cur] += 1
+        p = p*(p_bio+delta_bio)
+    return(p)
+
+
+def _gibbs_numpy(arrays,ca,trace,noits,delta_add,delta_bio,rng=None):
+    if rng is None:
+        rng = numpy.random.default_rng(random.getrandbits(64))
+    K = arrays['K']
+    starts = arrays['starts']
+    cnt_add, cnt_bio = _gibbs_counts(arrays,ca)
+    for it in tqdm(range(0,noits), desc = 'Gibbs Sampler Progress Bar'):
+        order = rng.permutation(K).tolist()
+        us = rng.random(K).tolist()
+        for i in order:
+            p = _gibbs_conditional(arrays,cnt_add,cnt_bio,ca,i,delta_add,delta_bio)
+            cum = numpy.cumsum(p)
+            c = min(int(numpy.searchsorted(cum,us[i]*cum[-1],side='right')),len(cum)-1)
+            if c!=ca[i]:
+                old = starts[i]+ca[i]
+                new = starts[i]+c
+                if cnt_add is not None:
+                    if arrays['key'][old]>=0:
+                        cnt_add[arrays['key'][old]] -= 1
+                    if arrays['key'][new]>=0:
+                        cnt_add[arrays['key'][new]] += 1
+                if cnt_bio is not None:
+                    if arrays['code'][old]>=0:
+                        cnt_bio[arrays['code'][old]] -= 1
+                    if arrays['code'][new]>=0:
+                        cnt_bio[arrays['code'][new]] += 1
+                ca[i] = c
+        _gibbs_record(trace,ca)
+    return(ca)
+
+
+def _gibbs_run(annotations,ks,rids,Bio,adjacency,index,delta_add,delta_bio,zs,noits,init,engine,
+               nchains,ncores,pool,record):
+    """
+    Runs the chains of a Gibbs sampler and returns the list of their records
+    (see _gibbs_trace()). record contains (burn,stop,thin,keep,path).
+    """
+    lens = [len(annotations[k].index) for k in ks]
+    if nchains>1:
+        burn, stop, thin, keep, path = record
+        seeds = numpy.random.SeedSequence(random.getrandbits(128)).spawn(nchains)
+        tasks = []
+        for c in range(0,nchains):
+            if path is None:
+                tasks.append((seeds[c],record))
             else:
-                data.append(iterations.MSMS_ann_iter2(df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln,k))
-        keys = list(df.iloc[ind,0])
-        annotations = dict(zip(keys, data))
-        end = time.time()
-        print(round(end - start,1), 'seconds elapsed')
-    elif ncores>1:
-        print("annotating based on MS1 and MS2 information - Parallelized...")
-        start = time.time()
-        if ppmunk is None:
-            ppmunk = ppm
-        if ppmthr is None:
-            ppmthr = 2*ppm
-        if ratiounk is None:
-            ratiounk = 0.5
-        if pRTNone is None:
-            pRTNone = 0.8
-        if pRTout is None:
-            pRTout = 0.4
-        annotations={}
-        ind = util.which(df.iloc[:,5]=='bp')+ util.which(df.iloc[:,5]=='potential bp') + util.whichNone(df.iloc[:,5])
-        ind.sort()
-        sigmaln = math.sqrt(1/ratiosd)
-        pool_obj = multiprocessing.Pool(ncores)
-        if evfilt:
-            data = pool_obj.map(partial(iterations.MSMS_ann_iter1,df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln),ind)
+                root, ext = os.path.splitext(path)
+                tasks.append((seeds[c],(burn,stop,thin,keep,root+'_'+str(c)+ext)))
+        args = (annotations,ks,rids,Bio,adjacency,index,delta_add,delta_bio,noits,init,engine)
+        if ncores>1:
+            print("running",nchains,"chains - Parallelized")
+            traces = _pool_map(min(ncores,nchains),pool,_gibbs_chain,args,tasks,star=True)
         else:
-            data = pool_obj.map(partial(iterations.MSMS_ann_iter2,df,dfMS2,allAdds,DBMS2,ppm,me,ratiosd,ppmthr,ppmunk,ratiounk,pRTNone,pRTout,mzdCS,ppmCS,CSunk,sigmaln),ind)
-        pool_obj.terminate()
-        keys = list(df.iloc[ind,0])
-        annotations = dict(zip(keys, data))
-        end = time.time()
-        print(round(end - start,1), 'seconds elapsed')
-    else:
-        raise ValueError("ncores must be >=1")
+            traces = [_gibbs_chain(*args,*task) for task in tasks]
+        for trace in traces:
+            if isinstance(trace['zs'],str):
+                trace['zs'] = numpy.load(trace['zs'],mmap_mode='r+')
+                trace['zs'].thin = trace['thin']
+        return(traces)
+    trace = _gibbs_trace(lens,zs,noits,*record)
+    ca, ca_id = _gibbs_init(annotations,ks,zs,init)
+    if zs is None:
+        _gibbs_record(trace,ca)
+    _gibbs_sweeps(annotations,ks,rids,Bio,adjacency,index,delta_add,delta_bio,ca,ca_id,trace,noits,engine)
+    return([trace])
 
-    return(annotations)       
 
+def _gibbs_chain(annotations,ks,rids,Bio,adjacency,index,delta_add,delta_bio,noits,init,engine,seed,record):
+    """
+    Runs one chain with the random streams spawned from seed. The state of
+    the random module of the calling process is restored afterwards. If the
+    samples are memory-mapped, the path of the file is returned instead of
+    the array.
+    """
+    state = random.getstate()
+    seed_random, seed_numpy = seed.spawn(2)
+    random.seed(int(seed_random.generate_state(1,numpy.uint64)[0]))
+    trace = _gibbs_trace([len(annotations[k].index) for k in ks],None,noits,*record)
+    ca, ca_id = _gibbs_init(annotations,ks,None,init)
+    _gibbs_record(trace,ca)
+    _gibbs_sweeps(annotations,ks,rids,Bio,adjacency,index,delta_add,delta_bio,ca,ca_id,trace,noits,engine,
+                  numpy.random.default_rng(seed_numpy))
+    random.setstate(state)
+    if trace['path'] is not None and trace['zs'] is not None:
+        trace['zs'].flush()
+        trace['zs'] = trace['path']
+    return(trace)
+
+
+def _gibbs_sweeps(annotations,ks,rids,Bio,adjacency,index,delta_add,delta_bio,ca,ca_id,trace,noits,engine,rng=None):
+    if engine=='numpy':
+        if delta_bio is None:
+            adjacency = None
+        _gibbs_numpy(_gibbs_arrays(annotations,ks,rids if delta_add is not None else None,adjacency,index),
+                     ca,trace,noits,delta_add,delta_bio,rng)
+        return(trace)
+    indk = list(range(0,len(ks)))
+    if delta_bio is not None and adjacency is not None:
+        codes, cur, counts = _bio_counts(adjacency,index,ks,annotations,ca_id)
+    for it in tqdm(range(0,noits), desc = 'Gibbs Sampler Progress Bar'):
+        if delta_bio is None:
+            ca, ca_id = iterations.gibbs_sampler_add_iter(indk,ks,rids,annotations,ca_id,ca,delta_add,it)
+        elif delta_add is None and adjacency is not None:
+            ca, ca_id = _gibbs_bio_sparse_iter(indk,ks,annotations,adjacency,codes,cur,counts,ca_id,ca,delta_bio,it)
+        elif delta_add is None:
+            ca, ca_id = iterations.gibbs_sampler_bio_iter(indk,ks,annotations,Bio,ca_id,ca,delta_bio,it)
+        elif adjacency is not None:
+            ca, ca_id = _gibbs_bio_add_sparse_iter(indk,ks,rids,annotations,adjacency,codes,cur,counts,ca_id,ca,delta_bio,delta_add,it)
+        else:
+            ca, ca_id = iterations.gibbs_sampler_bio_add_iter(indk,ks,rids,annotations,Bio,ca_id,ca,delta_bio,delta_add,it)
+        _gibbs_record(trace,ca)
+    return(trace)
+
+
+def _gibbs_posterior(annotations,ks,traces,n):
+    """
+    Adds the 'post Gibbs' and 'chi-square pval' columns to the annotations,
+    from the counts of the n samples of each chain (see _gibbs_trace())
+    pooled, and the 'R-hat' column if there is more than one chain.
+    """
+    starts = traces[0]['starts']
+    N = n*len(traces)
+    for m in range(0,len(ks)):
+        id= ks[m]
+        ncand = len(annotations[id].index)
+        C = numpy.array([trace['counts'][starts[m]:starts[m]+ncand] for trace in traces])
+        fs = C.sum(axis=0).tolist()
+        post_gibbs = list([0.0]*annotations[id].index)
+        observed = list([0.0]*annotations[id].index)
+        expected = list([0.0]*annotations[id].index)
+        pold= list(annotations[id]['post'])
+        for i in range(0,ncand):
+            if fs[i]>0:
+                post_gibbs[i] =fs[i]/N
+                observed[i] = fs[i]
+                expected[i] = pold[i]*N
+        annotations[id]['post Gibbs']=post_gibbs
+        keep = [i for i, e in enumerate(expected) if e != 0]
+        expected=[expected[i] for i in keep]
+        observed = [observed[i] for i in keep]
+        expected = [x+((sum(observed)-sum(expected))/len(expected)) for x in expected] ## when computing the expected frequencies there are numerical problems....
+        res = stats.chisquare(f_obs=observed, f_exp=expected)
+        annotations[id]['chi-square pval']= res.pvalue
+        if len(traces)>1:
+            annotations[id]['R-hat'] = _rhat(C,n)
+        if res.pvalue < 0.001:
+            annotations[id]=annotations[id].sort_values(by=['post Gibbs'], ascending=False)
+
+
+def _rhat(C,n):
+    """
+    Gelman-Rubin statistic computed from the counts C (chains x candidates)
+    of each candidate in n samples per chain. The statistic is computed for
+    the indicator variable of each candidate and the largest value is
+    returned (1 if no candidate varies within or between the chains, nan if
+    there are less than 2 samples per chain).
+    """
+    if n<2:
+        return(numpy.nan)
+    p = C/n
+    W = (p*(1-p)*n/(n-1)).mean(axis=0)
+    B = n*p.var(axis=0,ddof=1)
+    V = (n-1)/n*W+B/n
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        R = numpy.sqrt(V/W)
+    R[(W==0) & (B==0)] = 1.0
+    return(float(R.max()))
 
 
 def Gibbs_sampler_add(df,annotations,noits=100,burn=None,delta_add=1,
-                      all_out=False,zs=None):
+                      all_out=False,zs=None,init='batch',
+                      engine='legacy',nchains=1,ncores=1,pool=None,
+                      thin=1,trace_path=None,zs_thin=None):
     """
     Gibbs sampler considering only adduct connections. The function computes
     the posterior probabilities of the annotations considering the adducts
@@ -568,10 +2594,58 @@ def Gibbs_sampler_add(df,annotations,noits=100,burn=None,delta_add=1,
                parameter must be positive. The smaller the parameter the more
                weight the adducts connections have on the posterior
                probabilities. Default 1.
-    all_out: logical value. If true the list of assignments found in each
-             iteration is returned by the function. Default False.
-    zs: list of assignments computed in a previous run of the Gibbs sampler. 
-        Optional, default None.
+    all_out: logical value. If true the assignments found in each
+             iteration are returned by the function. If False only the
+             number of times each annotation is assigned is kept while
+             sampling. Default False.
+    zs: assignments computed in a previous run of the Gibbs sampler.
+        Optional, default None. If zs was thinned (its attribute thin is
+        larger than 1, see the parameter thin) its rows are not consecutive
+        samples: the sampler is restarted from its last row and only the new
+        noits iterations are used to compute 'post Gibbs'. The thinning of a
+        zs loaded with numpy.load(trace_path,mmap_mode='r') is read from the
+        file written next to it (see trace_path).
+    init: how the initial assignments are drawn when zs is None. If 'batch'
+          (default) they are drawn for all the features at once with a NumPy
+          generator seeded from the random module, so random.seed() still
+          makes the runs reproducible. If 'sequential' they are drawn one
+          feature at a time with random.choices(), as in previous versions.
+    engine: Defines how the sampler is run. If 'legacy' (default) each
+            feature is updated from its annotation dataframe. If 'numpy' the
+            annotations are encoded once into flat arrays (candidate ids,
+            'post' probabilities and adducts and biochemical connection codes)
+            and each feature is updated from those arrays, with a NumPy random
+            generator seeded from the random module. Both sample from the same
+            conditional probabilities, so 'post Gibbs' and 'chi-square pval'
+            agree up to the Monte Carlo error, but for the same seed the
+            individual samples differ.
+    nchains: default value 1. Number of independent chains. Each chain is
+             initialised and run for noits iterations with its own random
+             stream, spawned with numpy.random.SeedSequence from a seed drawn
+             from the random module. The samples after burn of all the chains
+             are pooled to compute 'post Gibbs' and 'chi-square pval', and the
+             Gelman-Rubin statistic of each feature is added in the column
+             'R-hat' (values close to 1 indicate that the chains converged to
+             the same distribution, nan if less than 2 samples are kept after
+             burn). zs can only be used if nchains=1.
+    ncores: default value 1. Number of cores used to run the chains in
+            parallel (only if nchains>1).
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1
+          and nchains>1). If None, a new pool is created for this call only.
+    thin: default value 1. If all_out=True, only every thin-th sample
+          (ending with the last one) is stored in zs, and zs.thin is set to
+          thin. All the samples after burn are used to compute 'post Gibbs'
+          in any case.
+    trace_path: default value None. If given and all_out=True, zs is stored
+                in a .npy file at this path and returned as a memory-mapped
+                array, so that long runs do not need to fit in memory. Its
+                thinning is stored in trace_path+'.json'. If nchains>1, the
+                index of the chain is added to the file name (e.g.
+                trace_0.npy).
+    zs_thin: default value None. Thinning of zs, if it cannot be found from
+             zs itself (e.g. a trace loaded fully in memory with numpy.load
+             or read from another format).
     
     Returns
     -------
@@ -580,80 +2654,53 @@ def Gibbs_sampler_add(df,annotations,noits=100,burn=None,delta_add=1,
                  posterior probabilities computed. The other is called
                  'chi-square pval' containing the p-value from a chi-squared
                  test comparing the 'post' with the 'post Gibbs' probabilities.
-    zs: optional, if all_out==True, the function return the full list of
-        assignments computed. This allows restarting the sampler from where
-        you are from a previous run.
+    zs: optional, if all_out==True, the function return the assignments
+        computed, as an integer numpy array (iterations x features) of the
+        positions of the assigned annotations (int16, or int32 if a feature
+        has more than 32767 annotations), with an attribute thin (see
+        GibbsTrace). This allows restarting the sampler from where you are
+        from a previous run. If nchains>1, the list of the zs of each chain.
     """
+    if init not in ['batch','sequential']:
+        raise ValueError("init not allowed")
+    if engine not in ['legacy','numpy']:
+        raise ValueError("engine not allowed")
+    if nchains<1:
+        raise ValueError("nchains must be >=1")
+    if ncores<1:
+        raise ValueError("ncores must be >=1")
+    if nchains>1 and zs is not None:
+        raise ValueError("zs can only be used with nchains=1")
+    if thin<1:
+        raise ValueError("thin must be >=1")
+    if zs_thin is not None and zs_thin<1:
+        raise ValueError("zs_thin must be >=1")
+    zs = _gibbs_zs(zs,zs_thin)
     start = time.time()
     print("computing posterior probabilities including adducts connections")
     print("initialising sampler ...")
     noits = int(noits) 
     
     ks = list(annotations.keys())
-    rids = [] #get a vector of relation ids associated with the annotated features
-    for k in ks:
-        rids.append(df[df['ids']==k]['rel.ids'].item())
-    ca = [] # initialise current annotation vector
-    ca_id = []
-
-
-
-    if zs is None:
-        for k in ks: ### go through each mass for which I have an annotation I CAN PARALLELIZE THIS
-            tmp = annotations[k]
-            P=list(tmp['post'])### vector of the probabilities currently assigned to each possible annotation
-            a_list = list(range(0,len(P))) ### I used this as vector of assignments
-            c=random.choices(a_list, P) ### for the mass k, randomly choose an annotation based on probabilities on P
-            ca.append(c) ### store the index
-            ca_id.append(tmp.iloc[c,0].item()) ### store the id   
-        zs = []
-        zs.append(ca.copy())
+    rids = _rel_ids(df,ks) #get a vector of relation ids associated with the annotated features
+    if zs is None or zs.thin>1:
         noits2=noits 
     else:
-        ca = zs[len(zs)-1]
-        ca_id = []
-        for i in range(0,len(ca)):
-            k=ks[i]
-            tmp = annotations[k]
-            ca_id.append(tmp.iloc[[ca[i]],0].item()) ### store the id
         noits2=noits+len(zs)
-    
-    indk = list(range(0,len(ks)))
-    for it in tqdm(range(0,noits), desc = 'Gibbs Sampler Progress Bar'):
-        ca, ca_id = iterations.gibbs_sampler_add_iter(indk,ks,rids,annotations,ca_id,ca,delta_add,it)
-        zs.append(ca.copy())          
-            
-    zsdf = pandas.DataFrame(zs).transpose()
-    
     if burn is None:
         burn = int(noits2*0.10)
+    traces = _gibbs_run(annotations,ks,rids,None,None,None,delta_add,None,zs,noits,init,engine,
+                        nchains,ncores,pool,(burn,noits2,thin,all_out,trace_path))
+    
     print('parsing results ...')
-    positions = range(burn,noits2)                                                   
-    for m in range(0,len(zsdf.index)):
-        id= ks[m]
-        post_gibbs = list([0.0]*annotations[id].index)
-        observed = list([0.0]*annotations[id].index)
-        expected = list([0.0]*annotations[id].index)
-        pold= list(annotations[id]['post'])
-        fs=collections.Counter(zsdf.iloc[m,positions])
-        for i in fs.keys():
-            post_gibbs[i] =fs[i]/len(positions)
-            observed[i] = fs[i]
-            expected[i] = pold[i]*len(positions)    
-        annotations[id]['post Gibbs']=post_gibbs
-        keep = [i for i, e in enumerate(expected) if e != 0]
-        expected=[expected[i] for i in keep]
-        observed = [observed[i] for i in keep]
-        expected = [x+((sum(observed)-sum(expected))/len(expected)) for x in expected] ## when computing the expected frequencies there are numerical problems....
-        res = stats.chisquare(f_obs=observed, f_exp=expected)
-        annotations[id]['chi-square pval']= res.pvalue
-        if res.pvalue < 0.001:
-            annotations[id]=annotations[id].sort_values(by=['post Gibbs'], ascending=False)
+    _gibbs_posterior(annotations,ks,traces,len(range(burn,noits2)))
     
     end = time.time()
     print('Done - ',round(end - start,1), 'seconds elapsed')
     if all_out:
-        return(zs)
+        if nchains>1:
+            return([trace['zs'] for trace in traces])
+        return(traces[0]['zs'])
 
     
 def Compute_Bio(DB, annotations=None, mode='reactions', connections = ["C3H5NO",
@@ -671,7 +2718,8 @@ def Compute_Bio(DB, annotations=None, mode='reactions', connections = ["C3H5NO",
                "C2H2O","C2H2","CO2","CHO2","H2O","H3O6P2","C2H4","CO","C2O2",
                "H2","O","P","C2H2O","CH2","HPO3","NH2","PP","NH","SO3","N",
                "C6H10O5","C6H10O6","C5H8O4","C12H20O11","C6H11O8P","C6H8O6",
-               "C6H10O5","C18H30O15"], ncores=1):
+               "C6H10O5","C18H30O15"], ncores=1, cachedir=None, pool=None,
+               engine='numpy', output='dataframe'):
     """
     Compute matrix of biochemical connections. Either based on a list of
     possible connections in the form of a list of formulas or based on the
@@ -720,12 +2768,86 @@ def Compute_Bio(DB, annotations=None, mode='reactions', connections = ["C3H5NO",
                 formulas. Only necessary if mode='connections'. A list of
                 common biotransformations is provided as default.
     ncores: default value 1. Number of cores used
+    cachedir: default value None. If provided, Bio is loaded from the disk
+              cache in this directory when the same DB, candidate ids, mode
+              and connections were already used, otherwise it is computed and
+              stored there (see clear_cache()).
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1).
+          If None, a new pool is created for this call only.
+    engine: Defines how the connections are computed. If 'numpy' (default)
+            each compound is only compared with the compounds it can be
+            connected to (ncores is not used). With mode='reactions' the
+            reactions of each compound are split once into an index from each
+            reaction to the compounds involved. With mode='connections' the
+            formula of each compound is parsed once into a vector of element
+            counts, and the partners of a compound are found by looking up
+            its vector plus the vector of each connection in a hash table.
+            If 'legacy' all the pairs of ids are checked one at a time. Both
+            give the same results.
+    output: either 'dataframe' (default) or 'sparse'. If 'sparse' the
+            connections are returned as a sparse adjacency matrix over the
+            ids in the DB (see bio_adjacency()), which can be passed as Bio
+            to Gibbs_sampler_bio() and Gibbs_sampler_bio_add().
     
     Returns
     -------
-        Bio: dataframe containing all the possible connections computed.
+        Bio: dataframe containing all the possible connections computed or,
+             if output='sparse', a tuple (adjacency, index) as returned by
+             bio_adjacency().
     """
-    if ncores==1:
+    if engine not in ['numpy','legacy']:
+        raise ValueError("engine not allowed")
+    if output not in ['dataframe','sparse']:
+        raise ValueError("output not allowed")
+    if cachedir is not None:
+        if annotations is None:
+            ids = None
+        else:
+            ids = sorted(set(itertools.chain.from_iterable(a['id'].tolist() for a in annotations.values())))
+        if mode=='connections':
+            key = _cache_key('Bio',DB,ids,mode,list(connections))
+        else:
+            key = _cache_key('Bio',DB,ids,mode)
+        Bio = _cache_load(cachedir,key)
+        if Bio is not None:
+            print("biochemical connections loaded from cache")
+            if output=='sparse':
+                return(bio_adjacency(Bio,DB['id'].tolist()))
+            return(Bio)
+    if engine=='numpy' and ncores>=1:
+        print("computing all possible biochemical connections")
+        start = time.time()
+        DB = DB.replace(numpy.nan,None)
+        DB.loc[DB.reactions==None,'reactions']=''
+            
+        ### getting the ids of all possible hits to the database
+        if annotations is None:
+            all_ids = DB['id'].to_list()
+        else:
+            all_Ks = list(annotations.keys())
+            all_ids = []
+            for k in all_Ks:
+                all_ids= all_ids+annotations[k]['id'].tolist()
+
+            all_ids = list(set(all_ids))
+            all_ids.remove('Unknown')
+
+        if mode=='connections':
+            print("considering the provided connections ...")
+            Bio = _connection_pairs(all_ids,DB['id'].to_list(),DB['formula'].to_list(),connections)
+        elif mode=='reactions':
+            print("considering the reactions stored in the database ...")
+            all_rs_DB = DB['reactions'].to_list()
+            all_rs_DB= ['' if v is None else v for v in all_rs_DB]
+            Bio = _reaction_pairs(all_ids,DB['id'].to_list(),all_rs_DB)
+        else:
+            print('ERROR: mode can only be connections or reactions')
+            return
+        Bio = pandas.DataFrame(Bio, index=None)
+        end = time.time()   
+        print(round(end - start,1), 'seconds elapsed')
+    elif ncores==1:
         print("computing all possible biochemical connections")
         start = time.time()
         DB = DB.replace(numpy.nan,None)
@@ -753,11 +2875,11 @@ def Compute_Bio(DB, annotations=None, mode='reactions', connections = ["C3H5NO",
             all_forms_DB = DB['formula'].to_list()
             conns = []
             for c in connections:
-                conns.append(molmass.Formula(c).formula)
+                conns.append(formula_hill(c))
             
             
             for x,y in itertools.combinations(all_ids, 2):
-                Bio = Bio+[iterations.bio_single_iter_connections(all_ids_DB,all_forms_DB,connections,x,y)]
+                Bio.append(iterations.bio_single_iter_connections(all_ids_DB,all_forms_DB,connections,x,y))
     
     
         
@@ -766,7 +2888,7 @@ def Compute_Bio(DB, annotations=None, mode='reactions', connections = ["C3H5NO",
             all_rs_DB = DB['reactions'].to_list()
             all_rs_DB= ['' if v is None else v for v in all_rs_DB]
             for x,y in itertools.combinations(all_ids, 2):
-                Bio = Bio+[iterations.bio_single_iter_reactions(all_ids_DB,all_rs_DB,x,y)]
+                Bio.append(iterations.bio_single_iter_reactions(all_ids_DB,all_rs_DB,x,y))
     
     
         
@@ -805,20 +2927,18 @@ def Compute_Bio(DB, annotations=None, mode='reactions', connections = ["C3H5NO",
             all_forms_DB = DB['formula'].to_list()
             conns = []
             for c in connections:
-                conns.append(molmass.Formula(c).formula)
+                conns.append(formula_hill(c))
             
-            pool_obj = multiprocessing.Pool(ncores)
-            Bio = pool_obj.starmap(partial(iterations.bio_single_iter_connections,all_ids_DB,all_forms_DB,connections),itertools.combinations(all_ids, 2))
-            pool_obj.terminate()
+            Bio = _pool_map(ncores,pool,iterations.bio_single_iter_connections,(all_ids_DB,all_forms_DB,connections),
+                            itertools.combinations(all_ids, 2),star=True)
     
         
         elif mode=='reactions':
             print("considering the reactions stored in the database ...")
             all_rs_DB = DB['reactions'].to_list()
             all_rs_DB= ['' if v is None else v for v in all_rs_DB]
-            pool_obj = multiprocessing.Pool(ncores)
-            Bio = pool_obj.starmap(partial(iterations.bio_single_iter_reactions,all_ids_DB,all_rs_DB),itertools.combinations(all_ids, 2))
-            pool_obj.terminate()
+            Bio = _pool_map(ncores,pool,iterations.bio_single_iter_reactions,(all_ids_DB,all_rs_DB),
+                            itertools.combinations(all_ids, 2),star=True)
     
         
         else:
@@ -832,15 +2952,215 @@ def Compute_Bio(DB, annotations=None, mode='reactions', connections = ["C3H5NO",
         print(round(end - start,1), 'seconds elapsed')
     else:
         raise ValueError("ncores must be >=1")
-        
+    if cachedir is not None:
+        _cache_store(cachedir,key,Bio)
+    if output=='sparse':
+        return(bio_adjacency(Bio,DB['id'].tolist()))
     return(Bio)
 
 
+def bio_adjacency(Bio,ids=None):
+    """
+    Convert a dataframe of biochemical connections into a sparse adjacency
+    matrix over integer-encoded ids.
+    
+    Parameters
+    ----------
+    Bio: dataframe (2 columns), reporting all the possible connections between
+         compounds. Output of Compute_Bio().
+    ids: list of ids to encode, e.g. DB['id']. If None (default), the ids
+         found in Bio are used in order of appearance. Ids in Bio that are not
+         in this list are added at the end.
+    
+    Returns
+    -------
+    adjacency: scipy CSR matrix (integer). The entry (i,j) is the number of
+               connections (i,j) and (j,i) in Bio, each counted once, so the
+               matrix is symmetric and the neighbours of id i are
+               adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i+1]].
+    index: dictionary mapping each id to its row in the adjacency matrix.
+    """
+    index = {}
+    if ids is not None:
+        for x in ids:
+            index.setdefault(x,len(index))
+    if len(Bio.index)>0:
+        for x in itertools.chain(Bio.iloc[:,0].tolist(),Bio.iloc[:,1].tolist()):
+            index.setdefault(x,len(index))
+        rows = numpy.array([index[x] for x in Bio.iloc[:,0].tolist()],dtype=numpy.int64)
+        cols = numpy.array([index[x] for x in Bio.iloc[:,1].tolist()],dtype=numpy.int64)
+    else:
+        rows = numpy.zeros(0,dtype=numpy.int64)
+        cols = numpy.zeros(0,dtype=numpy.int64)
+    n = len(index)
+    B = sparse.coo_matrix((numpy.ones(len(rows),dtype=numpy.int32),(rows,cols)),shape=(n,n)).tocsr()
+    B.data[:] = 1 ### repeated connections are only counted once
+    adjacency = (B + B.T - sparse.diags(B.diagonal(),format='csr')).tocsr()
+    adjacency.eliminate_zeros()
+    adjacency.sort_indices()
+    return(adjacency, index)
+
+
+def _bio_counts(adjacency,index,ks,annotations,ca_id):
+    codes = [[index.get(x,-1) for x in annotations[k]['id']] for k in ks]
+    cur = [index.get(x,-1) for x in ca_id]
+    counts = numpy.zeros(adjacency.shape[0],dtype=numpy.int64)
+    for c in cur:
+        if c>=0:
+            counts[c] += 1
+    return(codes, cur, counts)
+
+
+def _bio_links(adjacency,counts,codes):
+    p_bio = [0]*len(codes)
+    for cp in range(0,len(codes)):
+        c = codes[cp]
+        if c>=0:
+            s = adjacency.indptr[c]
+            e = adjacency.indptr[c+1]
+            nb = adjacency.indices[s:e]
+            p_bio[cp] = int(adjacency.data[s:e][counts[nb]>0].sum())
+    return(p_bio)
+
+
+def _gibbs_bio_sparse_iter(indk,ks,annotations,adjacency,codes,cur,counts,ca_id,ca,delta_bio,it):
+    random.shuffle(indk)
+    for i in indk:
+        k=ks[i]
+        tmp = annotations[k]
+        p = list(tmp['post'])
+        if cur[i]>=0:
+            counts[cur[i]] -= 1 ### without the annotation for the mass considered
+        p_bio = _bio_links(adjacency,counts,codes[i])
+        p_bio=[x+delta_bio for x in p_bio]
+        p_bio=[x/sum(p_bio) for x in p_bio]
+        p0= [a * b for a, b in zip(p, p_bio)]
+        p0=[x/sum(p0) for x in p0]
+        a_list = list(range(0,len(p0)))
+        c=random.choices(a_list, p0)
+        ca[i] = c[0]
+        ca_id[i] = tmp.iloc[c,0].item()
+        cur[i] = codes[i][c[0]]
+        if cur[i]>=0:
+            counts[cur[i]] += 1
+    return(ca, ca_id)
+
+
+def _gibbs_bio_add_sparse_iter(indk,ks,rids,annotations,adjacency,codes,cur,counts,ca_id,ca,delta_bio,delta_add,it):
+    random.shuffle(indk)
+    for i in indk: 
+        k = ks[i]
+        rid=rids[i]
+        tmp = annotations[k]
+        p = list(tmp['post'])
+        p_add = [0]*len(tmp.index)
+        ca_id2=[]
+        for r in range(0,len(rids)):
+            if rids[r]==rid and r!=k:
+                ca_id2.append(ca_id[r])
+        for cp in range(0,len(p_add)):
+            idcp = tmp.iloc[cp,0]
+            if idcp!='Unknown':
+                p_add[cp] = ca_id2.count(idcp)
+        if cur[i]>=0:
+            counts[cur[i]] -= 1 ### without the annotation for the mass considered
+        p_bio = _bio_links(adjacency,counts,codes[i])
+        p_add=[x+delta_add for x in p_add]
+        p_add=[x/sum(p_add) for x in p_add]
+        p_bio=[x+delta_bio for x in p_bio]
+        p_bio=[x/sum(p_bio) for x in p_bio]
+        p0= [a * b * c for a, b, c in zip(p, p_add, p_bio)]
+        p0=[x/sum(p0) for x in p0]
+        a_list = list(range(0,len(p0)))
+        c=random.choices(a_list, p0)
+        ca[i] = c[0]
+        ca_id[i] = tmp.iloc[c,0].item()
+        cur[i] = codes[i][c[0]]
+        if cur[i]>=0:
+            counts[cur[i]] += 1
+    return(ca, ca_id)
+
+
+def _reaction_pairs(all_ids,all_ids_DB,all_rs_DB):
+    """
+    Pairs of ids in all_ids that share at least one reaction (engine 'numpy'
+    of Compute_Bio()), in the order in which itertools.combinations(all_ids,2)
+    would find them. The reactions of each id are those of its first entry in
+    the DB, as in iterations.bio_single_iter_reactions().
+    """
+    first = {}
+    for i,v in enumerate(all_ids_DB):
+        first.setdefault(v,i)
+    # positions in all_ids of the compounds involved in each reaction
+    index = {}
+    for i,x in enumerate(all_ids):
+        for r in set(all_rs_DB[first[x]].split()):
+            index.setdefault(r,[]).append(i)
+    n = len(all_ids)
+    pairs = [numpy.zeros(0,dtype=numpy.int64)]
+    for pos in index.values():
+        if len(pos)>1:
+            pos = numpy.array(pos,dtype=numpy.int64)
+            i, j = numpy.triu_indices(len(pos),1)
+            pairs.append(pos[i]*n+pos[j])
+    pairs = numpy.unique(numpy.concatenate(pairs))
+    return([(all_ids[i],all_ids[j]) for i,j in zip((pairs//n).tolist(),(pairs%n).tolist())])
+
+
+def _connection_pairs(all_ids,all_ids_DB,all_forms_DB,connections):
+    """
+    Pairs of ids in all_ids whose formulas differ by one of the connections
+    (engine 'numpy' of Compute_Bio()), in the order in which
+    itertools.combinations(all_ids,2) would find them. As in
+    iterations.bio_single_iter_connections(), a pair is connected if one
+    formula has more atoms than the other for every element of both
+    (util.check_ded()) and their difference, in Hill notation, is one of
+    the connections as written (so connections not written in Hill notation
+    never match).
+    """
+    first = {}
+    for i,v in enumerate(all_ids_DB):
+        first.setdefault(v,i)
+    forms = [formula_elements(all_forms_DB[first[x]]) for x in all_ids]
+    conns = [formula_elements(c) for c in set(connections) if formula_hill(c)==c]
+    elements = {}
+    for f in forms+conns:
+        for e,c in f:
+            elements.setdefault(e,len(elements))
+
+    def counts(fs):
+        C = numpy.zeros((len(fs),len(elements)),dtype=numpy.int64)
+        for i,f in enumerate(fs):
+            for e,c in f:
+                C[i,elements[e]] = c
+        return(C)
+
+    C = counts(forms)
+    D = counts(conns)
+    # positions in all_ids of each vector of element counts
+    index = {}
+    for i in range(0,len(all_ids)):
+        index.setdefault(C[i,:].tobytes(),[]).append(i)
+    n = len(all_ids)
+    pairs = [numpy.zeros(0,dtype=numpy.int64)]
+    for d in D:
+        # the difference must contain every element of the smaller formula
+        for j in numpy.flatnonzero(~numpy.any((C>0) & (d==0)[None,:],axis=1)):
+            pos = index.get((C[j,:]+d).tobytes())
+            if pos is not None:
+                pos = numpy.array(pos,dtype=numpy.int64)
+                pairs.append(numpy.minimum(pos,j)*n+numpy.maximum(pos,j))
+    pairs = numpy.unique(numpy.concatenate(pairs))
+    return([(all_ids[i],all_ids[j]) for i,j in zip((pairs//n).tolist(),(pairs%n).tolist())])
+
+
 
 
 
 def Gibbs_sampler_bio(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
-                      all_out=False,zs=None):
+                      all_out=False,zs=None,init='batch',
+                      engine='legacy',nchains=1,ncores=1,pool=None,
+                      thin=1,trace_path=None,zs_thin=None):
     """
     Gibbs sampler considering only possible biochemical connections. The
     function computes the posterior probabilities of the annotations
@@ -858,7 +3178,11 @@ def Gibbs_sampler_bio(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
                  MSMSannotation() or MSMSannotation_Parallel
     Bio: dataframe (2 columns), reporting all the possible connections between
          compounds. It uses the unique ids from the database. It could be the
-         output of Compute_Bio() or Compute_Bio_Parallel().
+         output of Compute_Bio() or Compute_Bio_Parallel(). Alternatively, the
+         tuple (adjacency, index) returned by bio_adjacency() or by
+         Compute_Bio(output='sparse'), in which case the connections of each
+         candidate are looked up from its row of the adjacency matrix. Both
+         give the same results.
     noits: number of iterations if the Gibbs sampler to be run
     burn: number of iterations to be ignored when computing posterior
           probabilities. If None, is set to 10% of total iterations
@@ -866,10 +3190,58 @@ def Gibbs_sampler_bio(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
                The parameter must be positive. The smaller the parameter the
                more weight the adducts connections have on the posterior
                probabilities. Default 1.
-    all_out: logical value. If true the list of assignments found in each
-            iteration is returned by the function. Default False.
-    zs: list of assignments computed in a previous run of the Gibbs sampler.
-        Optional, default None.
+    all_out: logical value. If true the assignments found in each
+            iteration are returned by the function. If False only the
+            number of times each annotation is assigned is kept while
+            sampling. Default False.
+    zs: assignments computed in a previous run of the Gibbs sampler.
+        Optional, default None. If zs was thinned (its attribute thin is
+        larger than 1, see the parameter thin) its rows are not consecutive
+        samples: the sampler is restarted from its last row and only the new
+        noits iterations are used to compute 'post Gibbs'. The thinning of a
+        zs loaded with numpy.load(trace_path,mmap_mode='r') is read from the
+        file written next to it (see trace_path).
+    init: how the initial assignments are drawn when zs is None. If 'batch'
+          (default) they are drawn for all the features at once with a NumPy
+          generator seeded from the random module, so random.seed() still
+          makes the runs reproducible. If 'sequential' they are drawn one
+          feature at a time with random.choices(), as in previous versions.
+    engine: Defines how the sampler is run. If 'legacy' (default) each
+            feature is updated from its annotation dataframe. If 'numpy' the
+            annotations are encoded once into flat arrays (candidate ids,
+            'post' probabilities and adducts and biochemical connection codes)
+            and each feature is updated from those arrays, with a NumPy random
+            generator seeded from the random module. Both sample from the same
+            conditional probabilities, so 'post Gibbs' and 'chi-square pval'
+            agree up to the Monte Carlo error, but for the same seed the
+            individual samples differ.
+    nchains: default value 1. Number of independent chains. Each chain is
+             initialised and run for noits iterations with its own random
+             stream, spawned with numpy.random.SeedSequence from a seed drawn
+             from the random module. The samples after burn of all the chains
+             are pooled to compute 'post Gibbs' and 'chi-square pval', and the
+             Gelman-Rubin statistic of each feature is added in the column
+             'R-hat' (values close to 1 indicate that the chains converged to
+             the same distribution, nan if less than 2 samples are kept after
+             burn). zs can only be used if nchains=1.
+    ncores: default value 1. Number of cores used to run the chains in
+            parallel (only if nchains>1).
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1
+          and nchains>1). If None, a new pool is created for this call only.
+    thin: default value 1. If all_out=True, only every thin-th sample
+          (ending with the last one) is stored in zs, and zs.thin is set to
+          thin. All the samples after burn are used to compute 'post Gibbs'
+          in any case.
+    trace_path: default value None. If given and all_out=True, zs is stored
+                in a .npy file at this path and returned as a memory-mapped
+                array, so that long runs do not need to fit in memory. Its
+                thinning is stored in trace_path+'.json'. If nchains>1, the
+                index of the chain is added to the file name (e.g.
+                trace_0.npy).
+    zs_thin: default value None. Thinning of zs, if it cannot be found from
+             zs itself (e.g. a trace loaded fully in memory with numpy.load
+             or read from another format).
     
     Returns
     -------
@@ -879,94 +3251,56 @@ def Gibbs_sampler_bio(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
                  annotations are summarized in a pandas dataframe.
 
     """
+    if init not in ['batch','sequential']:
+        raise ValueError("init not allowed")
+    if engine not in ['legacy','numpy']:
+        raise ValueError("engine not allowed")
+    if nchains<1:
+        raise ValueError("nchains must be >=1")
+    if ncores<1:
+        raise ValueError("ncores must be >=1")
+    if nchains>1 and zs is not None:
+        raise ValueError("zs can only be used with nchains=1")
+    if thin<1:
+        raise ValueError("thin must be >=1")
+    if zs_thin is not None and zs_thin<1:
+        raise ValueError("zs_thin must be >=1")
+    zs = _gibbs_zs(zs,zs_thin)
     df=df.replace('None',None)
     start = time.time()
     print("computing posterior probabilities including biochemical connections")
     print("initialising sampler ...")
-    all_ids = []
-    for k in annotations.keys():
-        tmp = annotations[k]
-        all_ids=all_ids+list(tmp['id'])
-    all_ids=list(set(all_ids))
-
-    ind = []
-    for k in range(0,len(Bio.index)):
-        if Bio.iloc[k,0] in all_ids and Bio.iloc[k,1] in all_ids:
-            ind.append(k)
-        
-    Bio=Bio.iloc[ind,:]
-    del all_ids
-    del ind
-    del tmp
+    adjacency = None
+    index = None
+    if isinstance(Bio,tuple):
+        adjacency, index = Bio
+    elif engine=='numpy':
+        adjacency, index = bio_adjacency(Bio)
+    else:
+        Bio = _bio_filter(annotations,Bio)
     
     noits = int(noits) 
     
     ks = list(annotations.keys())
-    rids = [] #get a vector of relation ids associated with the annotated features
-    for k in ks:
-        rids.append(df[df['ids']==k]['rel.ids'].item())
-    ca = [] # initialise current annotation vector
-    ca_id = []
-    Bio = list(Bio.itertuples(index=False, name=None))
-
-
-    if zs is None:
-        for k in ks: ### go through each mass for which I have an annotation I CAN PARALLELIZE THIS
-            tmp = annotations[k]
-            P=list(tmp['post']) ### vector of the probabilities currently assigned to each possible annotation
-            a_list = list(range(0,len(P))) ### I used this as vector of assignments
-            c=random.choices(a_list, P) ### for the mass k, randomly choose an annotation based on probabilities on P
-            ca.append(c) ### store the index
-            ca_id.append(tmp.iloc[c,0].item()) ### store the id   
-        zs = []
-        zs.append(ca.copy())
+    rids = _rel_ids(df,ks) #get a vector of relation ids associated with the annotated features
+    if zs is None or zs.thin>1:
         noits2=noits 
     else:
-        ca = zs[len(zs)-1]
-        ca_id = []
-        for i in range(0,len(ca)):
-            k=ks[i]
-            tmp = annotations[k]
-            ca_id.append(tmp.iloc[[ca[i]],0].item()) ### store the id
         noits2=noits+len(zs)
-    
-    indk = list(range(0,len(ks)))
-    for it in tqdm(range(0,noits), desc = 'Gibbs Sampler Progress Bar'):
-        ca, ca_id = iterations.gibbs_sampler_bio_iter(indk,ks,annotations,Bio,ca_id,ca,delta_bio,it)
-        zs.append(ca.copy())          
-            
-    zsdf = pandas.DataFrame(zs).transpose()
-    
     if burn is None:
         burn = int(noits2*0.10)
-
+    traces = _gibbs_run(annotations,ks,None,Bio,adjacency,index,None,delta_bio,zs,noits,init,engine,
+                        nchains,ncores,pool,(burn,noits2,thin,all_out,trace_path))
+    
     print('parsing results ...')
-    positions = range(burn,noits2)                                                     
-    for m in range(0,len(zsdf.index)):
-        id= ks[m]
-        post_gibbs = list([0.0]*annotations[id].index)
-        observed = list([0.0]*annotations[id].index)
-        expected = list([0.0]*annotations[id].index)
-        pold= list(annotations[id]['post'])
-        fs=collections.Counter(zsdf.iloc[m,positions])
-        for i in fs.keys():
-            post_gibbs[i] =fs[i]/len(positions)
-            observed[i] = fs[i]
-            expected[i] = pold[i]*len(positions)    
-        annotations[id]['post Gibbs']=post_gibbs
-        keep = [i for i, e in enumerate(expected) if e != 0]
-        expected=[expected[i] for i in keep]
-        observed = [observed[i] for i in keep]
-        expected = [x+((sum(observed)-sum(expected))/len(expected)) for x in expected] ## when computing the expected frequencies there are numerical problems....
-        res = stats.chisquare(f_obs=observed, f_exp=expected)
-        annotations[id]['chi-square pval']= res.pvalue
-        if res.pvalue < 0.001:
-            annotations[id]=annotations[id].sort_values(by=['post Gibbs'], ascending=False)
+    _gibbs_posterior(annotations,ks,traces,len(range(burn,noits2)))
     
     end = time.time()
     print('Done - ',round(end - start,1), 'seconds elapsed')
     if all_out:
-        return(zs)
+        if nchains>1:
+            return([trace['zs'] for trace in traces])
+        return(traces[0]['zs'])
 
 
 
@@ -974,7 +3308,9 @@ def Gibbs_sampler_bio(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
 
 
 def Gibbs_sampler_bio_add(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
-                          delta_add=1,all_out=False,zs=None):
+                          delta_add=1,all_out=False,zs=None,init='batch',
+                          engine='legacy',nchains=1,ncores=1,pool=None,
+                          thin=1,trace_path=None,zs_thin=None):
     """
     Gibbs sampler considering both biochemical and adducts connections. The
     function computes the posterior probabilities of the annotations
@@ -993,7 +3329,11 @@ def Gibbs_sampler_bio_add(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
                  MSMSannotation() or MSMSannotation_Parallel
     Bio: dataframe (2 columns), reporting all the possible connections between
          compounds. It uses the unique ids from the database. It could be the
-         output of Compute_Bio() or Compute_Bio_Parallel().
+         output of Compute_Bio() or Compute_Bio_Parallel(). Alternatively, the
+         tuple (adjacency, index) returned by bio_adjacency() or by
+         Compute_Bio(output='sparse'), in which case the connections of each
+         candidate are looked up from its row of the adjacency matrix. Both
+         give the same results.
     noits: number of iterations if the Gibbs sampler to be run
     burn: number of iterations to be ignored when computing posterior
           probabilities. If None, is set to 10% of total iterations
@@ -1005,10 +3345,58 @@ def Gibbs_sampler_bio_add(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
                parameter must be positive. The smaller the parameter the more
                weight the adducts connections have on the posterior
                probabilities. Default 1.
-    all_out: logical value. If true the list of assignments found in each
-            iteration is returned by the function. Default False.
-    zs: list of assignments computed in a previous run of the Gibbs sampler.
-        Optional, default None.
+    all_out: logical value. If true the assignments found in each
+            iteration are returned by the function. If False only the
+            number of times each annotation is assigned is kept while
+            sampling. Default False.
+    zs: assignments computed in a previous run of the Gibbs sampler.
+        Optional, default None. If zs was thinned (its attribute thin is
+        larger than 1, see the parameter thin) its rows are not consecutive
+        samples: the sampler is restarted from its last row and only the new
+        noits iterations are used to compute 'post Gibbs'. The thinning of a
+        zs loaded with numpy.load(trace_path,mmap_mode='r') is read from the
+        file written next to it (see trace_path).
+    init: how the initial assignments are drawn when zs is None. If 'batch'
+          (default) they are drawn for all the features at once with a NumPy
+          generator seeded from the random module, so random.seed() still
+          makes the runs reproducible. If 'sequential' they are drawn one
+          feature at a time with random.choices(), as in previous versions.
+    engine: Defines how the sampler is run. If 'legacy' (default) each
+            feature is updated from its annotation dataframe. If 'numpy' the
+            annotations are encoded once into flat arrays (candidate ids,
+            'post' probabilities and adducts and biochemical connection codes)
+            and each feature is updated from those arrays, with a NumPy random
+            generator seeded from the random module. Both sample from the same
+            conditional probabilities, so 'post Gibbs' and 'chi-square pval'
+            agree up to the Monte Carlo error, but for the same seed the
+            individual samples differ.
+    nchains: default value 1. Number of independent chains. Each chain is
+             initialised and run for noits iterations with its own random
+             stream, spawned with numpy.random.SeedSequence from a seed drawn
+             from the random module. The samples after burn of all the chains
+             are pooled to compute 'post Gibbs' and 'chi-square pval', and the
+             Gelman-Rubin statistic of each feature is added in the column
+             'R-hat' (values close to 1 indicate that the chains converged to
+             the same distribution, nan if less than 2 samples are kept after
+             burn). zs can only be used if nchains=1.
+    ncores: default value 1. Number of cores used to run the chains in
+            parallel (only if nchains>1).
+    pool: default value None. Pool of worker processes created with
+          worker_pool() and shared with other calls (only used if ncores>1
+          and nchains>1). If None, a new pool is created for this call only.
+    thin: default value 1. If all_out=True, only every thin-th sample
+          (ending with the last one) is stored in zs, and zs.thin is set to
+          thin. All the samples after burn are used to compute 'post Gibbs'
+          in any case.
+    trace_path: default value None. If given and all_out=True, zs is stored
+                in a .npy file at this path and returned as a memory-mapped
+                array, so that long runs do not need to fit in memory. Its
+                thinning is stored in trace_path+'.json'. If nchains>1, the
+                index of the chain is added to the file name (e.g.
+                trace_0.npy).
+    zs_thin: default value None. Thinning of zs, if it cannot be found from
+             zs itself (e.g. a trace loaded fully in memory with numpy.load
+             or read from another format).
     
     Returns
     -------
@@ -1017,97 +3405,62 @@ def Gibbs_sampler_bio_add(df,annotations,Bio,noits=100,burn=None,delta_bio=1,
                 posterior probabilities computed. The other is called
                 'chi-square pval' containing the p-value from a chi-squared
                 test comparing the 'post' with the 'post Gibbs' probabilities.
-    zs: optional, if all_out==True, the function return the full list of
-        assignments computed. This allows restarting the sampler from where you
-        are from a previous run
+    zs: optional, if all_out==True, the function return the assignments
+        computed, as an integer numpy array (iterations x features) of the
+        positions of the assigned annotations (int16, or int32 if a feature
+        has more than 32767 annotations), with an attribute thin (see
+        GibbsTrace). This allows restarting the sampler from where you are
+        from a previous run. If nchains>1, the list of the zs of each chain.
     """
+    if init not in ['batch','sequential']:
+        raise ValueError("init not allowed")
+    if engine not in ['legacy','numpy']:
+        raise ValueError("engine not allowed")
+    if nchains<1:
+        raise ValueError("nchains must be >=1")
+    if ncores<1:
+        raise ValueError("ncores must be >=1")
+    if nchains>1 and zs is not None:
+        raise ValueError("zs can only be used with nchains=1")
+    if thin<1:
+        raise ValueError("thin must be >=1")
+    if zs_thin is not None and zs_thin<1:
+        raise ValueError("zs_thin must be >=1")
+    zs = _gibbs_zs(zs,zs_thin)
     start = time.time()
     print("computing posterior probabilities including biochemical and adducts connections")
     print("initialising sampler ...")
     df=df.replace('None',None)
-    all_ids = []
-    for k in annotations.keys():
-        tmp = annotations[k]
-        all_ids=all_ids+list(tmp['id'])
-    all_ids=list(set(all_ids))
-
-    ind = []
-    for k in range(0,len(Bio.index)):
-        if Bio.iloc[k,0] in all_ids and Bio.iloc[k,1] in all_ids:
-            ind.append(k)
-        
-    Bio=Bio.iloc[ind,:]
-    del all_ids
-    del ind
-    del tmp
+    adjacency = None
+    index = None
+    if isinstance(Bio,tuple):
+        adjacency, index = Bio
+    elif engine=='numpy':
+        adjacency, index = bio_adjacency(Bio)
+    else:
+        Bio = _bio_filter(annotations,Bio)
  
     noits = int(noits) 
     ks = list(annotations.keys())    
-    rids = [] #get a vector of relation ids associated with the annotated features
-    for k in ks:
-        rids.append(df[df['ids']==k]['rel.ids'].item())
-    ca = [] # initialise current annotation vector
-    ca_id = []
-    Bio = list(Bio.itertuples(index=False, name=None))
-
-
-    if zs is None:
-        for k in ks: ### go through each mass for which I have an annotation I CAN PARALLELIZE THIS
-            tmp = annotations[k]
-            P=list(tmp['post']) ### vector of the probabilities currently assigned to each possible annotation
-            a_list = list(range(0,len(P))) ### I used this as vector of assignments
-            c=random.choices(a_list, P) ### for the mass k, randomly choose an annotation based on probabilities on P
-            ca.append(c) ### store the index
-            ca_id.append(tmp.iloc[c,0].item()) ### store the id   
-        zs = []
-        zs.append(ca.copy())
+    rids = _rel_ids(df,ks) #get a vector of relation ids associated with the annotated features
+    if zs is None or zs.thin>1:
         noits2=noits 
     else:
-        ca = zs[len(zs)-1]
-        ca_id = []
-        for i in range(0,len(ca)):
-            k=ks[i]
-            tmp = annotations[k]
-            ca_id.append(tmp.iloc[[ca[i]],0].item()) ### store the id
         noits2=noits+len(zs)
-    
-    indk = list(range(0,len(ks)))
-    for it in tqdm(range(0,noits), desc = 'Gibbs Sampler Progress Bar'):
-        ca, ca_id = iterations.gibbs_sampler_bio_add_iter(indk,ks,rids,annotations,Bio,ca_id,ca,delta_bio,delta_add,it)
-        zs.append(ca.copy())          
-            
-    zsdf = pandas.DataFrame(zs).transpose()
-    
     if burn is None:
         burn = int(noits2*0.10)
+    traces = _gibbs_run(annotations,ks,rids,Bio,adjacency,index,delta_add,delta_bio,zs,noits,init,engine,
+                        nchains,ncores,pool,(burn,noits2,thin,all_out,trace_path))
+    
     print('parsing results ...')
-    positions = range(burn,noits2)                                                     
-    for m in range(0,len(zsdf.index)):
-        id= ks[m]
-        post_gibbs = list([0.0]*annotations[id].index)
-        observed = list([0.0]*annotations[id].index)
-        expected = list([0.0]*annotations[id].index)
-        pold= list(annotations[id]['post'])
-        fs=collections.Counter(zsdf.iloc[m,positions])
-        for i in fs.keys():
-            post_gibbs[i] =fs[i]/len(positions)
-            observed[i] = fs[i]
-            expected[i] = pold[i]*len(positions)    
-        annotations[id]['post Gibbs']=post_gibbs
-        keep = [i for i, e in enumerate(expected) if e != 0]
-        expected=[expected[i] for i in keep]
-        observed = [observed[i] for i in keep]
-        expected = [x+((sum(observed)-sum(expected))/len(expected)) for x in expected] ## when computing the expected frequencies there are numerical problems....
-        res = stats.chisquare(f_obs=observed, f_exp=expected)
-        annotations[id]['chi-square pval']= res.pvalue
-        if res.pvalue < 0.001:
-            annotations[id]=annotations[id].sort_values(by=['post Gibbs'], ascending=False)
-
+    _gibbs_posterior(annotations,ks,traces,len(range(burn,noits2)))
     
     end = time.time()
     print('Done - ',round(end - start,1), 'seconds elapsed')
     if all_out:
-        return(zs)
+        if nchains>1:
+            return([trace['zs'] for trace in traces])
+        return(traces[0]['zs'])
 
 
 def simpleIPA(df,ionisation,DB,adductsAll,ppm,dfMS2=None,DBMS2=None,noits=100,
@@ -1115,7 +3468,7 @@ def simpleIPA(df,ionisation,DB,adductsAll,ppm,dfMS2=None,DBMS2=None,noits=100,
               mode='reactions',CSunk=0.5,isodiff=1,ppmiso=100,ncores=1,
               me=5.48579909065e-04,ratiosd=0.9,ppmunk=None,ratiounk=None,
               ppmthr=None,pRTNone=None,pRTout=None,mzdCS=0, ppmCS=10,
-              evfilt=False,
+              evfilt=False,cachedir=CACHE_DIR,
               connections = ["C3H5NO", "C6H12N4O", "C4H6N2O2", "C4H5NO3",
                              "C3H5NOS", "C6H10N2O3S2","C5H7NO3","C5H8N2O2",
                              "C2H3NO","C6H7N3O","C6H11NO","C6H11NO","C6H12N2O",
@@ -1231,6 +3584,9 @@ def simpleIPA(df,ionisation,DB,adductsAll,ppm,dfMS2=None,DBMS2=None,noits=100,
     connections: list of possible connections between compounds defined as
                 formulas. Only necessary if mode='connections'. A list of
                 common biotransformations is provided as default.
+    cachedir: directory of the disk cache used for the all adducts table and
+              the Bio matrix. Default CACHE_DIR (environment variable
+              IPA_CACHE_DIR or ~/.ipa_cache). If None, nothing is cached.
     Output:
         annotations: a dictionary containing all the possible annotations for the measured features. The keys of the dictionary are the
                      unique ids for the features present in df. For each feature, the annotations are summarized in a pandas dataframe.
@@ -1245,24 +3601,36 @@ def simpleIPA(df,ionisation,DB,adductsAll,ppm,dfMS2=None,DBMS2=None,noits=100,
         raise ValueError("df not in the correct format")
         
     
-    # computing all adducts
+    # one pool of workers shared by all the parallel steps
+    if ncores>1:
+        pool = worker_pool(ncores)
+    else:
+        pool = None
+
+    try:
+        # computing all adducts
    
-    allAdds = compute_all_adducts(adductsAll= adductsAll, DB=DB, ionisation=ionisation ,ncores=ncores)
+        allAdds = compute_all_adducts(adductsAll= adductsAll, DB=DB, ionisation=ionisation ,ncores=ncores,
+                                      cachedir=cachedir,pool=pool)
    
 
-    # computing priors
-    if (dfMS2 is None) or (DBMS2 is None):
-        annotations = MS1annotation(df=df,allAdds=allAdds,ppm=ppm,me=me,ratiosd=ratiosd,ppmunk=ppmunk,
-        ratiounk=ratiounk,ppmthr=ppmthr,pRTNone=pRTNone,pRTout=pRTout,ncores=ncores)
-    else:
+        # computing priors
+        if (dfMS2 is None) or (DBMS2 is None):
+            annotations = MS1annotation(df=df,allAdds=allAdds,ppm=ppm,me=me,ratiosd=ratiosd,ppmunk=ppmunk,
+            ratiounk=ratiounk,ppmthr=ppmthr,pRTNone=pRTNone,pRTout=pRTout,ncores=ncores,pool=pool)
+        else:
     
-        annotations = MSMSannotation(df=df,dfMS2=dfMS2,allAdds=allAdds,DBMS2=DBMS2,ppm=ppm,me=me,ratiosd=ratiosd,
-        ppmunk=ppmunk,ratiounk=ratiounk,ppmthr=ppmthr,pRTNone=pRTNone,pRTout=pRTout,mzdCS=mzdCS,ppmCS=ppmCS,
-        CSunk=CSunk,evfilt=evfilt,ncores=ncores)
+            annotations = MSMSannotation(df=df,dfMS2=dfMS2,allAdds=allAdds,DBMS2=DBMS2,ppm=ppm,me=me,ratiosd=ratiosd,
+            ppmunk=ppmunk,ratiounk=ratiounk,ppmthr=ppmthr,pRTNone=pRTNone,pRTout=pRTout,mzdCS=mzdCS,ppmCS=ppmCS,
+            CSunk=CSunk,evfilt=evfilt,ncores=ncores,pool=pool)
 
-    # computing Bio matrix (if necessary)
-    if (Bio is None) and (delta_bio is not None):
-        Bio=Compute_Bio(DB=DB,annotations=annotations,mode=mode,connections=connections,ncores=ncores)
+        # computing Bio matrix (if necessary)
+        if (Bio is None) and (delta_bio is not None):
+            Bio=Compute_Bio(DB=DB,annotations=annotations,mode=mode,connections=connections,ncores=ncores,
+                            cachedir=cachedir,pool=pool,output='sparse')
+    finally:
+        if pool is not None:
+            pool.terminate()
         
     # Gibbs sampler (if needed). Which one based on the inputs
     if (Bio is not None) and (delta_bio is not None) and (delta_add is not None):
@@ -1274,5 +3642,210 @@ def simpleIPA(df,ionisation,DB,adductsAll,ppm,dfMS2=None,DBMS2=None,noits=100,
     
     return(annotations)
 
-        
 
+
+def clear_cache(cachedir=CACHE_DIR):
+    """
+    Removes all the entries stored in the disk cache used by
+    compute_all_adducts() and Compute_Bio(). It should be called when the
+    tables need to be recomputed even if their inputs did not change (e.g.,
+    after updating ipaPy2). Other files in cachedir are left untouched.
+    
+    Parameters
+    ----------
+    cachedir: directory of the cache. Default CACHE_DIR
+    
+    Returns
+    -------
+    n: number of entries removed
+    """
+    n = 0
+    for f in _cache_entries(cachedir):
+        os.remove(f)
+        n = n+1
+    print(n, 'cache entries removed')
+    return(n)
+
+
+def _cache_key(name,*args):
+    """
+    Returns the key of a cache entry: the name of the table followed by a hash
+    of the content of the inputs it was computed from.
+    """
+    h = hashlib.sha1()
+    for a in args:
+        _cache_hash(h,a)
+    return(name+'-'+h.hexdigest())
+
+
+def _cache_hash(h,obj):
+    if isinstance(obj, pandas.DataFrame):
+        h.update(repr((list(obj.columns),[str(d) for d in obj.dtypes])).encode())
+        h.update(pandas.util.hash_pandas_object(obj,index=False).to_numpy().tobytes())
+    elif isinstance(obj,(list,tuple)):
+        h.update(b'[')
+        for v in obj:
+            _cache_hash(h,v)
+        h.update(b']')
+    else:
+        h.update(repr(obj).encode())
+        h.update(b';')
+
+
+def _cache_entries(cachedir):
+    if not os.path.isdir(cachedir):
+        return([])
+    return([os.path.join(cachedir,f) for f in os.listdir(cachedir)
+            if CACHE_ENTRY.match(f)])
+
+
+def _cache_load(cachedir,key):
+    """
+    Returns the table stored in the cache with the given key, or None if it is
+    not there.
+    """
+    exts = ['.feather','.pkl'] if CACHE_PICKLE else ['.feather']
+    for ext in exts:
+        f = os.path.join(cachedir,key+ext)
+        if os.path.exists(f):
+            try:
+                if ext=='.feather':
+                    df = _feather_read(f)
+                else:
+                    df = pandas.read_pickle(f)
+            except Exception:
+                return(None)
+            os.utime(f) # used to evict the least recently used entries
+            return(df)
+    return(None)
+
+
+def _cache_store(cachedir,key,df,maxsize=None):
+    """
+    Stores df in the cache as a feather file (see _feather_write()), checking
+    that it is read back unchanged. If that is not possible (e.g. pyarrow is
+    not installed) the table is stored with pickle if CACHE_PICKLE, and not
+    stored otherwise. The least recently used entries are then removed until
+    the cache is smaller than maxsize MB (default CACHE_MAXSIZE).
+    """
+    if maxsize is None:
+        maxsize = CACHE_MAXSIZE
+    os.makedirs(cachedir,exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cachedir,suffix='.tmp')
+    os.close(fd)
+    try:
+        ext = None
+        try:
+            _feather_write(df,tmp)
+            if _feather_read(tmp).equals(df):
+                ext = '.feather'
+        except Exception:
+            pass
+        if ext is None and CACHE_PICKLE:
+            df.to_pickle(tmp)
+            ext = '.pkl'
+        if ext is None:
+            print("table not cached: it cannot be stored as feather (is pyarrow installed?)")
+        else:
+            ### mkstemp creates files readable only by the owner, the cache
+            ### can be shared: use the same mode as any other new file
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp,0o666 & ~umask)
+            os.replace(tmp,os.path.join(cachedir,key+ext))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    entries = sorted(_cache_entries(cachedir),key=os.path.getmtime)
+    size = sum(os.path.getsize(f) for f in entries)
+    while len(entries)>1 and size>maxsize*1024*1024:
+        size = size-os.path.getsize(entries[0])
+        os.remove(entries[0])
+        entries = entries[1:]
+
+
+def _feather_write(df,path):
+    """
+    Writes df to a feather file. Feather needs string column names and typed
+    columns, so the columns are stored as '0','1',... with their names in the
+    metadata, and object columns are stored as columns of their single value
+    type (str, int, float or bool), with None and NaN recorded so that
+    _feather_read() restores them exactly. Raises ValueError for tables that
+    cannot be stored like this (mixed types, non default index).
+    """
+    import pyarrow
+    from pyarrow import feather
+    if not df.index.equals(pandas.RangeIndex(len(df.index))):
+        raise ValueError("only tables with a default index can be cached")
+    meta = {'columns':[],'object':{}}
+    data = {}
+    types = {str:pyarrow.string(),int:pyarrow.int64(),float:pyarrow.float64(),bool:pyarrow.bool_()}
+    for j in range(0,len(df.columns)):
+        c = df.columns[j]
+        if not isinstance(c,(str,int)):
+            raise ValueError("column names can only be str or int")
+        meta['columns'].append([c,type(c).__name__])
+        col = df.iloc[:,j]
+        if col.dtype!=object:
+            data[str(j)] = pyarrow.array(col.to_numpy())
+            continue
+        vals = col.tolist()
+        isnan = [isinstance(v,float) and v!=v for v in vals]
+        isnull = [v is None or n for v, n in zip(vals,isnan)]
+        kinds = set(type(v) for v, n in zip(vals,isnull) if not n)
+        if len(kinds)>1 or not kinds<=set(types):
+            raise ValueError("mixed object column")
+        kind = kinds.pop() if kinds else str
+        if not any(isnan):
+            nan = 'none'
+        elif all(n==m for n, m in zip(isnan,isnull)):
+            nan = 'all'
+        else:
+            nan = 'mask'
+            data[str(j)+'.nan'] = pyarrow.array(isnan,type=pyarrow.bool_())
+        meta['object'][str(j)] = [kind.__name__,nan]
+        data[str(j)] = pyarrow.array([None if n else v for v, n in zip(vals,isnull)],type=types[kind])
+    table = pyarrow.table(data) if data else pyarrow.table({'rows':pyarrow.nulls(len(df.index))})
+    table = table.replace_schema_metadata({'ipa':json.dumps(meta)})
+    feather.write_feather(table,path)
+
+
+def _feather_read(path):
+    from pyarrow import feather
+    table = feather.read_table(path)
+    meta = json.loads(table.schema.metadata[b'ipa'])
+    cols = {}
+    for j, (c, ctype) in enumerate(meta['columns']):
+        name = int(c) if ctype=='int' else c
+        if str(j) in meta['object']:
+            kind, nan = meta['object'][str(j)]
+            vals = table.column(str(j)).to_pylist()
+            if nan=='all':
+                vals = [numpy.nan if v is None else v for v in vals]
+            elif nan=='mask':
+                isnan = table.column(str(j)+'.nan').to_pylist()
+                vals = [numpy.nan if n else v for v, n in zip(vals,isnan)]
+            cols[name] = pandas.Series(vals,dtype=object)
+        else:
+            cols[name] = pandas.Series(table.column(str(j)).to_numpy())
+    if not cols:
+        return(pandas.DataFrame(index=pandas.RangeIndex(table.num_rows)))
+    return(pandas.DataFrame(cols))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the IPA disk cache and compile MS2 libraries")
+    parser.add_argument('command',choices=['clear','info','compile-ms2'])
+    parser.add_argument('paths',nargs='*',help="compile-ms2: MS2 database csv file and output directory")
+    parser.add_argument('--cachedir',default=CACHE_DIR)
+    args = parser.parse_args()
+    if args.command=='compile-ms2':
+        if len(args.paths)!=2:
+            parser.error("compile-ms2 needs the MS2 database csv file and the output directory")
+        compile_ms2_library(args.paths[0],args.paths[1])
+    elif args.command=='clear':
+        clear_cache(args.cachedir)
+    else:
+        entries = _cache_entries(args.cachedir)
+        size = sum(os.path.getsize(f) for f in entries)
+        print(args.cachedir+':',len(entries),'entries,',round(size/(1024*1024),1),'MB')
@@ -1,6 +1,6 @@
 import os
 import pandas as pd
-from ipa import simpleIPA, clusterFeatures, map_isotope_patterns, compute_all_adducts, Gibbs_sampler_add, MSMSannotation, MS1annotation, Gibbs_sampler_bio, Gibbs_sampler_bio_add
+from ipa import simpleIPA, clusterFeatures, map_isotope_patterns, compute_all_adducts, Gibbs_sampler_add, MSMSannotation, MS1annotation, Gibbs_sampler_bio, Gibbs_sampler_bio_add, CACHE_DIR, worker_pool, bio_adjacency
 
 def run_ipa_pipeline(
     ms1_input_path,
@@ -56,111 +56,149 @@ def run_ipa_pipeline(
     advanced = advanced_options or {}
     ncores_eff = advanced.get("ncores", ncores)
     ncores_eff = max(1, min(ncores_eff, os.cpu_count() or 1))
-
-    if run_clustering:
-        print("Step 2: Running clustering on MS1 features...")
-        df = clusterFeatures(
-            df_raw,
-            Cthr=advanced.get("clustering_Cthr", 0.8),
-            RTwin=advanced.get("clustering_RTwin", 1),
-            Intmode=advanced.get("clustering_Intmode", "max")
-        )
-    else:
-        print("Step 2: Clustering skipped.")
-        df = df_raw
-
-    print("Step 3: Mapping isotope patterns...")
-    map_isotope_patterns(
-        df,
-        isoDiff=advanced.get("isoDiff", 1),
-        ppm=advanced.get("isotope_ppm", 100),
-        ionisation=ionisation,
-        MinIsoRatio=advanced.get("MinIsoRatio", 0.5)
-    )
-
-    print("Step 4: Loading adducts and MS1 database...")
-    adducts = pd.read_csv(adducts_path)
-    db = pd.read_csv(db_ms1_path)
-
-    print("Step 5: Computing all adduct formulas...")
-    allAdds = compute_all_adducts(
-        adducts,
-        db,
-        ionisation=ionisation,
-        ncores=ncores_eff
-    )
-
-    if ms2_input_path and db_ms2_path:
-        print("Step 6: Performing MS2-based annotation...")
-        dfMS2 = pd.read_csv(ms2_input_path)
-        DBMS2 = pd.read_csv(db_ms2_path)
-        annotations = MSMSannotation(
-            df, dfMS2, allAdds, DBMS2, ppm,
-            me=advanced.get("me", 5.48579909065e-04),
-            ratiosd=advanced.get("ratiosd", 0.9),
-            ppmunk=advanced.get("ppmunk"),
-            ratiounk=advanced.get("ratiounk"),
-            ppmthr=advanced.get("ppmthr"),
-            pRTNone=advanced.get("pRTNone"),
-            pRTout=advanced.get("pRTout"),
-            mzdCS=advanced.get("mzdCS", 0),
-            ppmCS=advanced.get("ppmCS", 10),
-            CSunk=advanced.get("CSunk", 0.7),
-            evfilt=advanced.get("evfilt", False),
-            ncores=ncores_eff
-        )
-    else:
-        print("Step 6: Performing MS1-only annotation (no MS2 inputs provided or validated).")
-        annotations = MS1annotation(
-            df, allAdds, ppm,
-            me=advanced.get("me", 5.48579909065e-04),
-            ratiosd=advanced.get("ratiosd", 0.9),
-            ppmunk=advanced.get("ppmunk"),
-            ratiounk=advanced.get("ratiounk"),
-            ppmthr=advanced.get("ppmthr"),
-            pRTNone=advanced.get("pRTNone"),
-            pRTout=advanced.get("pRTout"),
-            ncores=ncores_eff
-        )
-
+    # allAdds only depends on the DB, adducts and ionisation, so it is reused
+    # across runs from the disk cache unless disabled
+    cachedir = advanced.get("cache_dir", CACHE_DIR) if advanced.get("use_cache", True) else None
+    # checked before the worker pool is started
     if run_gibbs:
-        print(f"Step 7: Running Gibbs sampler ({gibbs_version})...")
-        burn = advanced.get("burn", None)
-        all_out = advanced.get("all_out", False)
-
-        if gibbs_version == "adduct":
-            Gibbs_sampler_add(
-                df, annotations,
-                noits=gibbs_iterations,
-                burn=burn,
-                delta_add=advanced.get("delta_add", 1),
-                all_out=all_out
-            )
-        elif gibbs_version == "biochemical":
+        if gibbs_version == "biochemical":
             if not Bio or not os.path.exists(Bio):
                 raise FileNotFoundError("Biological network file is required for 'biochemical' Gibbs sampler.")
-            bio_df = pd.read_csv(Bio)
-            Gibbs_sampler_bio(
-                df, annotations, Bio=bio_df,
-                noits=gibbs_iterations,
-                burn=burn,
-                delta_bio=advanced.get("delta_bio", 1),
-                all_out=all_out
-            )
         elif gibbs_version == "biochemical and adduct":
             if not Bio or not os.path.exists(Bio):
                 raise FileNotFoundError("Biological network file is required for 'biochemical and adduct' Gibbs sampler.")
-            bio_df = pd.read_csv(Bio)
-            Gibbs_sampler_bio_add(
-                df, annotations, Bio=bio_df,
-                noits=gibbs_iterations,
-                burn=burn,
-                delta_bio=advanced.get("delta_bio", 1),
-                delta_add=advanced.get("delta_add", 1),
-                all_out=all_out
+        elif gibbs_version != "adduct":
+            raise ValueError(f"Unsupported Gibbs sampler version: {gibbs_version}")
+
+    # one pool of workers shared by steps 2-7 instead of one per step
+    pool = worker_pool(ncores_eff) if ncores_eff > 1 else None
+
+    try:
+        if run_clustering:
+            print("Step 2: Running clustering on MS1 features...")
+            df = clusterFeatures(
+                df_raw,
+                Cthr=advanced.get("clustering_Cthr", 0.8),
+                RTwin=advanced.get("clustering_RTwin", 1),
+                Intmode=advanced.get("clustering_Intmode", "max"),
+                ncores=ncores_eff,
+                pool=pool
             )
         else:
-            raise ValueError(f"Unsupported Gibbs sampler version: {gibbs_version}")
+            print("Step 2: Clustering skipped.")
+            df = df_raw
+
+        print("Step 3: Mapping isotope patterns...")
+        map_isotope_patterns(
+            df,
+            isoDiff=advanced.get("isoDiff", 1),
+            ppm=advanced.get("isotope_ppm", 100),
+            ionisation=ionisation,
+            MinIsoRatio=advanced.get("MinIsoRatio", 0.5),
+            ncores=ncores_eff,
+            compact=advanced.get("isotope_compact", False),
+            pool=pool
+        )
+
+        print("Step 4: Loading adducts and MS1 database...")
+        adducts = pd.read_csv(adducts_path)
+        db = pd.read_csv(db_ms1_path)
+
+        print("Step 5: Computing all adduct formulas...")
+        allAdds = compute_all_adducts(
+            adducts,
+            db,
+            ionisation=ionisation,
+            ncores=ncores_eff,
+            cachedir=cachedir,
+            pool=pool
+        )
+
+        if ms2_input_path and db_ms2_path:
+            print("Step 6: Performing MS2-based annotation...")
+            dfMS2 = pd.read_csv(ms2_input_path)
+            # a directory is an MS2 library compiled with ipa.compile_ms2_library()
+            DBMS2 = db_ms2_path if os.path.isdir(db_ms2_path) else pd.read_csv(db_ms2_path)
+            annotations = MSMSannotation(
+                df, dfMS2, allAdds, DBMS2, ppm,
+                me=advanced.get("me", 5.48579909065e-04),
+                ratiosd=advanced.get("ratiosd", 0.9),
+                ppmunk=advanced.get("ppmunk"),
+                ratiounk=advanced.get("ratiounk"),
+                ppmthr=advanced.get("ppmthr"),
+                pRTNone=advanced.get("pRTNone"),
+                pRTout=advanced.get("pRTout"),
+                mzdCS=advanced.get("mzdCS", 0),
+                ppmCS=advanced.get("ppmCS", 10),
+                CSunk=advanced.get("CSunk", 0.7),
+                evfilt=advanced.get("evfilt", False),
+                CSmode=advanced.get("CSmode", "pairwise"),
+                ncores=ncores_eff,
+                pool=pool
+            )
+        else:
+            print("Step 6: Performing MS1-only annotation (no MS2 inputs provided or validated).")
+            annotations = MS1annotation(
+                df, allAdds, ppm,
+                me=advanced.get("me", 5.48579909065e-04),
+                ratiosd=advanced.get("ratiosd", 0.9),
+                ppmunk=advanced.get("ppmunk"),
+                ratiounk=advanced.get("ratiounk"),
+                ppmthr=advanced.get("ppmthr"),
+                pRTNone=advanced.get("pRTNone"),
+                pRTout=advanced.get("pRTout"),
+                ncores=ncores_eff,
+                pool=pool
+            )
+
+        if run_gibbs:
+            print(f"Step 7: Running Gibbs sampler ({gibbs_version})...")
+            burn = advanced.get("burn", None)
+            all_out = advanced.get("all_out", False)
+            nchains = advanced.get("gibbs_nchains", 1)
+
+            if gibbs_version == "adduct":
+                Gibbs_sampler_add(
+                    df, annotations,
+                    noits=gibbs_iterations,
+                    burn=burn,
+                    delta_add=advanced.get("delta_add", 1),
+                    all_out=all_out,
+                    engine=advanced.get("gibbs_engine", "legacy"),
+                    nchains=nchains,
+                    ncores=ncores_eff,
+                    pool=pool
+                )
+            elif gibbs_version == "biochemical":
+                bio_df = pd.read_csv(Bio)
+                Gibbs_sampler_bio(
+                    df, annotations, Bio=bio_adjacency(bio_df),
+                    noits=gibbs_iterations,
+                    burn=burn,
+                    delta_bio=advanced.get("delta_bio", 1),
+                    all_out=all_out,
+                    engine=advanced.get("gibbs_engine", "legacy"),
+                    nchains=nchains,
+                    ncores=ncores_eff,
+                    pool=pool
+                )
+            elif gibbs_version == "biochemical and adduct":
+                bio_df = pd.read_csv(Bio)
+                Gibbs_sampler_bio_add(
+                    df, annotations, Bio=bio_adjacency(bio_df),
+                    noits=gibbs_iterations,
+                    burn=burn,
+                    delta_bio=advanced.get("delta_bio", 1),
+                    delta_add=advanced.get("delta_add", 1),
+                    all_out=all_out,
+                    engine=advanced.get("gibbs_engine", "legacy"),
+                    nchains=nchains,
+                    ncores=ncores_eff,
+                    pool=pool
+                )
+    finally:
+        if pool is not None:
+            pool.terminate()
 
     print("Step 8: Building merged output table...")
     out = []